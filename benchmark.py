@@ -0,0 +1,407 @@
+# benchmark.py
+"""
+Benchmark del pipeline con datos sintéticos con la misma forma que JEFAB
+(el archivo real no puede salir del share seguro).
+
+- Generador: encabezados con mojibake, EDAD2 con faltantes, GENERO y
+  ESTADO_CIVIL con mayúsculas/espacios mezclados, filas duplicadas y
+  columnas de relleno para simular el ancho real de la hoja.
+- Arnés: mide tiempo (pared y CPU) y memoria (pico de tracemalloc y RSS)
+  de run_calidad, run_demografia, run_familiar y build_resumen por tamaño,
+  y guarda un JSON que sirve de línea base para detectar regresiones.
+
+Uso:
+  python benchmark.py --filas 10k 100k
+  python benchmark.py --filas 1M --formato csv --memoria
+  python benchmark.py --filas 100k --comparar benchmark_base.json
+  python benchmark.py --generar 100k --salida-datos datos/sintetico.xlsx
+  python benchmark.py --arranque --presupuesto-ms 150
+  python benchmark.py --verificar
+"""
+
+from pathlib import Path
+import argparse
+import contextlib
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource  # pico de RSS (solo Unix)
+except ImportError:
+    resource = None
+
+import numpy as np
+import pandas as pd
+
+import datos_exploracion as de
+
+# ---------------------------------------------------------------------
+# Generador de datos sintéticos
+# ---------------------------------------------------------------------
+GENEROS = ["MASCULINO", "FEMENINO", "masculino", "Femenino ", "M", "F", "HOMBRE", "MUJER"]
+ESTADOS = ["CASADO", "casado", " Casado", "SOLTERO", "soltero ", "UNION LIBRE", "Unión libre",
+           "DIVORCIADO", "SEPARADO", "VIUDO"]
+GRADOS = ["CT", "MY", "TC", "CR", "TE", "ST", "T1", "T2", "T3", "T4", "SS", "S1", "S2", "AT", "NO RESPONDE"]
+SI_NO = ["SI", "NO", "si", "No", "SÍ", None, "NO SABE"]
+CIUDADES = ["BOGOTÃ\u0081", "CALI", "MEDELLÃ\u008dN", "BARRANQUILLA", "MELGAR", "RIONEGRO"]
+
+def _parse_filas(txt: str) -> int:
+    """'10k' -> 10000, '1M' -> 1000000."""
+    txt = str(txt).strip()
+    mult = {"k": 1_000, "K": 1_000, "m": 1_000_000, "M": 1_000_000}.get(txt[-1], 1)
+    return int(float(txt[:-1] if mult > 1 else txt) * mult)
+
+def generar_sintetico(n: int, ancho: int = 20, pct_dup: float = 0.01, seed: int = 0) -> pd.DataFrame:
+    """DataFrame con el esquema y las rarezas de JEFAB (n filas + ~pct_dup duplicadas)."""
+    rng = np.random.default_rng(seed)
+    edad = rng.normal(36, 9, n).clip(18, 65).round()
+    edad[rng.random(n) < 0.02] = np.nan
+    n_hijos = rng.poisson(1.2, n).astype(float)
+    n_hijos[rng.random(n) < 0.5] = np.nan
+    data = {
+        "EDAD2": edad,
+        "GENERO": rng.choice(GENEROS, n, p=[.45, .15, .1, .05, .1, .05, .05, .05]),
+        "ESTADO_CIVIL": rng.choice(ESTADOS, n),
+        "GRADO": rng.choice(GRADOS, n),
+        "HIJOS": rng.choice(np.array(SI_NO, dtype=object), n),
+        "NUMERO_HIJOS": n_hijos,
+        "HABITA_VIVIENDA_FAMILIAR": rng.choice(np.array(SI_NO, dtype=object), n),
+        # encabezados con doble encoding, como en el archivo real
+        "CIUDAD  DE  RESIDENCIAÃ³N": rng.choice(CIUDADES, n),
+        "AÃ±OS  DE SERVICIO": rng.integers(0, 35, n),
+        "OBSERVACIONES": np.char.add("comentario libre ", rng.integers(0, 5000, n).astype(str)),
+    }
+    for i in range(ancho):
+        data[f"P{i + 1:03d}"] = rng.integers(1, 6, n)   # ítems Likert de relleno
+    df = pd.DataFrame(data)
+    n_dup = int(n * pct_dup)
+    if n_dup:
+        df = pd.concat([df, df.sample(n_dup, random_state=seed)], ignore_index=True)
+    return df
+
+def escribir_sintetico(df: pd.DataFrame, path: Path) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix.lower() == ".csv":
+        df.to_csv(path, index=False)
+    else:
+        if len(df) > 1_048_575:
+            raise ValueError("xlsx admite como máximo 1.048.576 filas; use --formato csv.")
+        try:
+            import xlsxwriter  # noqa: F401
+            df.to_excel(path, index=False, engine="xlsxwriter")
+        except ImportError:
+            df.to_excel(path, index=False)
+    return path
+
+# ---------------------------------------------------------------------
+# Arnés de medición
+# ---------------------------------------------------------------------
+def _rss_mb():
+    """Pico de RSS del proceso en MB (ru_maxrss está en KB en Linux y en bytes en macOS);
+    None donde no hay módulo resource (Windows)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def _medir(nombre: str, fn, filas: int, registros: list):
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    t0, c0 = time.perf_counter(), time.process_time()
+    out = fn()
+    reg = {
+        "etapa": nombre,
+        "filas": filas,
+        "seg": round(time.perf_counter() - t0, 4),
+        "cpu_seg": round(time.process_time() - c0, 4),
+    }
+    rss = _rss_mb()
+    if rss is not None:
+        reg["rss_max_mb"] = round(rss, 1)
+    if tracemalloc.is_tracing():
+        reg["pico_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+    registros.append(reg)
+    print(f"  {nombre:<16} {reg['seg']:>9.3f} s" + (f"  pico {reg['pico_mb']} MB" if "pico_mb" in reg else ""))
+    return out
+
+def medir_tamano(n: int, formato: str, ancho: int, registros: list) -> None:
+    tmp = Path(tempfile.mkdtemp(prefix="bench_fac_"))
+    try:
+        fuente = tmp / "datos" / f"JEFAB_2024.{formato}"
+        escribir_sintetico(generar_sintetico(n, ancho=ancho), fuente)
+        de.configurar_rutas(tmp, fuente)
+        de.INCREMENTAL = False    # medir siempre el trabajo completo
+        print(f"{n} filas ({formato}):")
+
+        cal  = _medir("run_calidad", lambda: de.run_calidad(export=False), n, registros)
+        ctx  = cal["ctx"]
+        _medir("run_demografia", lambda: de.run_demografia(ctx=ctx), n, registros)
+        _medir("run_familiar", lambda: de.run_familiar(ctx=ctx), n, registros)
+        _medir("build_resumen", lambda: de.build_resumen(export=False), n, registros)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def comparar(actual: list, base_path: Path, tolerancia: float) -> int:
+    """Imprime las etapas más lentas que la línea base; devuelve cuántas hay."""
+    base = {(r["etapa"], r["filas"]): r for r in json.loads(base_path.read_text(encoding="utf-8"))["resultados"]}
+    regresiones = 0
+    for r in actual:
+        b = base.get((r["etapa"], r["filas"]))
+        if b and r["seg"] > b["seg"] * (1 + tolerancia):
+            regresiones += 1
+            print(f"REGRESIÓN {r['etapa']} ({r['filas']} filas): {b['seg']:.3f}s -> {r['seg']:.3f}s")
+    return regresiones
+
+# ---------------------------------------------------------------------
+# Presupuesto de arranque: importar el script no debe cargar pandas, numpy
+# ni matplotlib (--help, errores de argumentos y --no-figs son inmediatos)
+# ---------------------------------------------------------------------
+MODULOS_PESADOS = ("pandas", "numpy", "matplotlib")
+
+def _proceso_limpio(args: list, cwd: Path) -> tuple:
+    t0 = time.perf_counter()
+    out = subprocess.run([sys.executable, *args], cwd=cwd, capture_output=True, text=True, check=True)
+    return time.perf_counter() - t0, out.stdout
+
+def medir_arranque(repeticiones: int = 5) -> dict:
+    """Mediana en procesos nuevos del import del script y de `--help`.
+
+    El import se mide dentro del proceso (sin el arranque del intérprete);
+    `--help` es el tiempo de pared descontando un `python -c pass`.
+    """
+    script = Path(de.__file__).resolve()
+    codigo = ("import sys, time; t = time.perf_counter(); import datos_exploracion; "
+              "print(time.perf_counter() - t); "
+              f"print(','.join(m for m in {MODULOS_PESADOS!r} if m in sys.modules))")
+    imports, ayuda, vacio, pesados = [], [], [], set()
+    for _ in range(repeticiones):
+        lineas = _proceso_limpio(["-c", codigo], script.parent)[1].splitlines()
+        imports.append(float(lineas[0]))
+        pesados.update(m for m in lineas[1].split(",") if m)
+        ayuda.append(_proceso_limpio([str(script), "--help"], script.parent)[0])
+        vacio.append(_proceso_limpio(["-c", "pass"], script.parent)[0])
+    return {
+        "import_ms": round(1000 * statistics.median(imports), 1),
+        "help_ms": round(1000 * (statistics.median(ayuda) - statistics.median(vacio)), 1),
+        "modulos_pesados": sorted(pesados),
+    }
+
+def revisar_arranque(medida: dict, presupuesto_ms: float) -> int:
+    """Imprime la medida y devuelve cuántas condiciones del presupuesto no se cumplen."""
+    print(f"import datos_exploracion: {medida['import_ms']:.1f} ms (presupuesto {presupuesto_ms:.0f} ms)")
+    print(f"--help (sin el arranque de Python): {medida['help_ms']:.1f} ms")
+    fallas = 0
+    if medida["import_ms"] > presupuesto_ms:
+        fallas += 1
+        print(f"FUERA DE PRESUPUESTO: el import tarda {medida['import_ms']:.1f} ms")
+    if medida["modulos_pesados"]:
+        fallas += 1
+        print(f"FUERA DE PRESUPUESTO: el import carga {', '.join(medida['modulos_pesados'])}")
+    return fallas
+
+# ---------------------------------------------------------------------
+# Verificaciones (--verificar): casos chicos con resultado conocido que
+# cubren regresiones ya vistas; cada una devuelve la lista de fallas
+# ---------------------------------------------------------------------
+@contextlib.contextmanager
+def _proyecto_temporal():
+    """Carpeta de proyecto desechable; al salir se restauran las rutas del script."""
+    tmp = Path(tempfile.mkdtemp(prefix="bench_fac_"))
+    previo = (de.PROJECT_DIR, de.DATA_PATH, de.REPORT_DIR, de.SCHEMA_PATH, de.INCREMENTAL)
+    try:
+        yield tmp
+    finally:
+        de.configurar_rutas(previo[0], previo[1], previo[2])
+        de.SCHEMA_PATH, de.INCREMENTAL = previo[3:]
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def _comparar_modos(chunksize: int) -> list:
+    """Fallas si la limpieza en memoria y la por bloques no dejan los mismos datos."""
+    mem = de.run_calidad(save_md=False, export=False)
+    blo = de.run_calidad_stream(chunksize, save_md=False)
+    ctx, limpio = mem["ctx"], pd.read_csv(blo["clean_file"])
+    fallas = []
+    if len(ctx.df) != len(limpio):
+        fallas.append(f"registros: {len(ctx.df)} en memoria, {len(limpio)} por bloques")
+    for clave in ("duplicados_eliminados", "edad_imputada_media"):
+        if mem[clave] != blo[clave]:
+            fallas.append(f"{clave}: {mem[clave]} en memoria, {blo[clave]} por bloques")
+    for rol, col in ctx.cols.items():
+        if col is None:
+            fallas.append(f"no se encontró la columna del rol '{rol}'")
+        elif col in limpio.columns:
+            a = ctx.df[col].dropna().astype(str).value_counts().sort_index().to_dict()
+            b = limpio[col].dropna().astype(str).value_counts().sort_index().to_dict()
+            if col != ctx.cols["edad"] and a != b:
+                fallas.append(f"valores de {col} distintos entre los dos modos")
+    return fallas
+
+def verificar_bloques_como_memoria() -> list:
+    """--chunksize deja los mismos datos que la limpieza en memoria, también en un
+    libro con varias hojas guardado con otra hoja activa (se lee la primera)."""
+    with _proyecto_temporal() as tmp:
+        fuente = tmp / "datos" / "JEFAB_2024.xlsx"
+        fuente.parent.mkdir(parents=True)
+        with pd.ExcelWriter(fuente, engine="openpyxl") as xw:
+            generar_sintetico(400, ancho=2).to_excel(xw, sheet_name="datos", index=False)
+            pd.DataFrame({"nota": ["hoja auxiliar"]}).to_excel(xw, sheet_name="notas", index=False)
+            xw.book.active = 1
+        de.configurar_rutas(tmp, fuente)
+        de.INCREMENTAL = False
+        return _comparar_modos(150)
+
+def verificar_columnas_sin_valores() -> list:
+    """Una columna de texto vacía (o un bloque entero sin valores en ella) no rompe la limpieza."""
+    df = generar_sintetico(400, ancho=2)
+    df["ESTADO_CIVIL"] = None
+    df.loc[:149, "GENERO"] = None   # el primer bloque de 150 filas sin género
+    fallas = []
+    for formato in ("xlsx", "csv"):
+        with _proyecto_temporal() as tmp:
+            fuente = escribir_sintetico(df, tmp / "datos" / f"JEFAB_2024.{formato}")
+            de.configurar_rutas(tmp, fuente)
+            de.INCREMENTAL = False
+            try:
+                fallas += [f"{formato}: {f}" for f in _comparar_modos(150)]
+            except Exception as e:
+                fallas.append(f"{formato}: {type(e).__name__}: {e}")
+    return fallas
+
+def _comparar_duplicados(df: pd.DataFrame, normalize: bool = False) -> list:
+    """Fallas si _find_duplicates o _dedupe_mask (en dos bloques) no coinciden con DataFrame.duplicated."""
+    esperado = (~df.duplicated()).tolist()
+    modo = "normalizado" if normalize else "exacto"
+    fallas = []
+    try:
+        keep = de._find_duplicates(df, modo=modo).keep.tolist()
+        if keep != esperado:
+            fallas.append(f"_find_duplicates ({modo}): {keep} (esperado {esperado})")
+        seen, mitad = set(), len(df) // 2
+        keep = np.concatenate([de._dedupe_mask(df.iloc[:mitad], seen, normalize=normalize),
+                               de._dedupe_mask(df.iloc[mitad:], seen, normalize=normalize)]).tolist()
+        if keep != esperado:
+            fallas.append(f"_dedupe_mask por bloques ({modo}): {keep} (esperado {esperado})")
+    except Exception as e:
+        fallas.append(f"{modo}: {type(e).__name__}: {e}")
+    return fallas
+
+def verificar_duplicados_tipos_mixtos() -> list:
+    """En modo exacto 1 y "1" son filas distintas, como en DataFrame.duplicated."""
+    df = pd.DataFrame({"A": pd.Series([1, "1", 1, "a", "b", "a"], dtype=object), "B": ["x"] * 6})
+    return _comparar_duplicados(df)
+
+def verificar_clave_sin_valores() -> list:
+    """Una columna clave sin ningún valor no rompe la detección de duplicados."""
+    df = pd.DataFrame({"A": pd.Series([None] * 4, dtype=object), "B": [np.nan] * 4, "C": [1, 2, 1, 3]})
+    return _comparar_duplicados(df) + _comparar_duplicados(df, normalize=True)
+
+def verificar_recarga_esquema() -> list:
+    """Con --serve, editar el esquema cambia los datos servidos (la caché no lo tapa)."""
+    figuras = de.FIGURAS
+    fallas = []
+    with _proyecto_temporal() as tmp:
+        df = generar_sintetico(300, ancho=0)
+        df["EDAD_REAL"] = df["EDAD2"] + 100    # otra columna de edad, también con faltantes
+        fuente = escribir_sintetico(df, tmp / "datos" / "JEFAB_2024.csv")
+        esquema = tmp / "esquema_columnas.toml"
+        texto = de.SCHEMA_PATH.read_text(encoding="utf-8")
+        esquema.write_text(texto, encoding="utf-8")
+        de.configurar_rutas(tmp, fuente)
+        de.SCHEMA_PATH, de.INCREMENTAL, de.FIGURAS = esquema, True, False
+        try:
+            srv = de.Servidor()
+            srv.cargar()
+            antes = (srv.ctx.cols["edad"], srv.ctx.df[srv.ctx.cols["edad"]].mean())
+            esquema.write_text(texto.replace('alias = ["EDAD2", ', 'alias = ["EDAD_REAL", "EDAD2", '), encoding="utf-8")
+            if srv._firma() == srv.firma:
+                fallas.append("la firma del servidor no notó la edición del esquema")
+            srv.cargar()
+            despues = (srv.ctx.cols["edad"], srv.ctx.df[srv.ctx.cols["edad"]].mean())
+            if despues[0] != "EDAD_REAL" or not despues[1] > 100:
+                fallas.append(f"tras editar el esquema la edad sigue siendo {despues[0]} "
+                              f"(media {despues[1]:.1f}; antes {antes[0]}, media {antes[1]:.1f})")
+            if srv.ctx.df["EDAD_REAL"].isna().any():
+                fallas.append("EDAD_REAL quedó sin imputar tras la recarga")
+        finally:
+            de.FIGURAS = figuras
+    return fallas
+
+VERIFICACIONES = [verificar_bloques_como_memoria, verificar_columnas_sin_valores,
+                  verificar_duplicados_tipos_mixtos, verificar_clave_sin_valores,
+                  verificar_recarga_esquema]
+
+def verificar() -> int:
+    """Corre las verificaciones; devuelve cuántas fallaron."""
+    fallidas = 0
+    for fn in VERIFICACIONES:
+        fallas = fn()
+        fallidas += bool(fallas)
+        print(f"{'FALLA' if fallas else 'ok':<5} {fn.__name__}")
+        for f in fallas:
+            print(f"      {f}")
+    return fallidas
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="Benchmark del pipeline FAC con datos sintéticos.")
+    ap.add_argument("--filas", nargs="+", default=["10k", "100k"],
+                    help="Tamaños a medir (10k, 100k, 1M, 10M).")
+    ap.add_argument("--formato", choices=["xlsx", "csv"], default=None,
+                    help="Formato de la fuente sintética (por defecto xlsx hasta 100k filas, csv desde ahí).")
+    ap.add_argument("--ancho", type=int, default=20, help="Columnas de relleno extra (ítems Likert).")
+    ap.add_argument("--memoria", action="store_true",
+                    help="Mide el pico de memoria con tracemalloc (hace todo más lento).")
+    ap.add_argument("--salida", type=Path, default=Path("benchmark_resultados.json"),
+                    help="JSON con los resultados (sirve como línea base).")
+    ap.add_argument("--comparar", type=Path, default=None,
+                    help="Línea base previa; sale con código 1 si alguna etapa es más lenta.")
+    ap.add_argument("--tolerancia", type=float, default=0.2,
+                    help="Margen permitido frente a la línea base (0.2 = 20%%).")
+    ap.add_argument("--generar", metavar="FILAS", default=None,
+                    help="Solo genera un archivo sintético de FILAS filas (ver --salida-datos).")
+    ap.add_argument("--salida-datos", type=Path, default=Path("datos") / "JEFAB_sintetico.xlsx")
+    ap.add_argument("--arranque", action="store_true",
+                    help="Solo mide el arranque del script; sale con código 1 si excede el presupuesto.")
+    ap.add_argument("--verificar", action="store_true",
+                    help="Solo corre las verificaciones de regresión; sale con código 1 si alguna falla.")
+    ap.add_argument("--presupuesto-ms", type=float, default=150,
+                    help="Tiempo máximo del import de datos_exploracion para --arranque.")
+    return ap.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.arranque:
+        sys.exit(1 if revisar_arranque(medir_arranque(), args.presupuesto_ms) else 0)
+    if args.verificar:
+        sys.exit(1 if verificar() else 0)
+    if args.generar:
+        path = escribir_sintetico(generar_sintetico(_parse_filas(args.generar), ancho=args.ancho), args.salida_datos)
+        print(f"Datos sintéticos: {path}")
+        sys.exit(0)
+
+    if args.memoria:
+        tracemalloc.start()
+    registros = []
+    for txt in args.filas:
+        n = _parse_filas(txt)
+        formato = args.formato or ("xlsx" if n <= 100_000 else "csv")
+        medir_tamano(n, formato, args.ancho, registros)
+
+    args.salida.write_text(json.dumps({
+        "fecha": time.strftime("%Y-%m-%d %H:%M"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "plataforma": platform.platform(),
+        "memoria_tracemalloc": args.memoria,
+        "resultados": registros,
+    }, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"Resultados: {args.salida}")
+
+    if args.comparar and comparar(registros, args.comparar, args.tolerancia):
+        sys.exit(1)
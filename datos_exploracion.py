@@ -12,17 +12,58 @@ Uso:
   python datos_exploracion.py --familiar
 """
 
+from __future__ import annotations
+
 from pathlib import Path
 import argparse
+import ast
+import contextlib
 import datetime as dt
+import hashlib
+import importlib
+import io
+import json
+import os
 import re
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-
-# Backend no interactivo (por si no hay GUI)
-import matplotlib
-matplotlib.use("Agg")
+import sys
+import threading
+import time
+import tokenize
+import tracemalloc
+import urllib.parse
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import TYPE_CHECKING, Optional, TypedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, wraps
+
+class _Diferido:
+    """Módulo pesado que se importa la primera vez que se usa uno de sus atributos.
+
+    Así `--help`, los errores de argumentos y el esquema no pagan el import de
+    pandas/numpy (~0.3 s). Al primer uso el nombre global se reemplaza por el
+    módulo real, y desde ahí no hay costo extra.
+    """
+    def __init__(self, modulo: str, alias: str):
+        self._modulo, self._alias = modulo, alias
+
+    def __getattr__(self, attr):
+        mod = importlib.import_module(self._modulo)
+        globals()[self._alias] = mod
+        return getattr(mod, attr)
+
+pd = _Diferido("pandas", "pd")
+np = _Diferido("numpy", "np")
+asyncio = _Diferido("asyncio", "asyncio")   # solo lo usa --serve
+# matplotlib solo se importa al dibujar (_new_axes); con --no-figs nunca se carga
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
+
+try:
+    import resource  # pico de RSS (solo Unix)
+except ImportError:
+    resource = None
 
 # ---------------------------------------------------------------------
 # Rutas del proyecto (seguras para .py y notebooks)
@@ -31,7 +72,208 @@ PROJECT_DIR = Path(__file__).resolve().parent if "__file__" in globals() else Pa
 DATA_PATH   = PROJECT_DIR / "datos" / "JEFAB_2024.xlsx"
 REPORT_DIR  = PROJECT_DIR / "reportes"
 FIG_DIR     = REPORT_DIR / "figs"
-CLEAN_PATH  = REPORT_DIR / "datos_limpios.xlsx"  # dataset limpio generado
+CLEAN_CSV_PATH = REPORT_DIR / "datos_limpios.csv"  # salida del modo por bloques
+CACHE_DIR   = REPORT_DIR / ".cache"               # caché columnar del dataset limpio
+MANIFEST_PATH = REPORT_DIR / ".manifest.json"     # hashes de entradas/salidas por paso y figura
+
+# Re-ejecución incremental: si es False (--force) se regenera todo
+INCREMENTAL = True
+
+# Procesos para dibujar figuras en paralelo (--jobs); 1 = en serie
+JOBS = 1
+
+# Si es False (--no-figs) no se dibuja nada ni se importa matplotlib
+FIGURAS = True
+
+# Formato de exportación del dataset limpio (--format) y si se escribe en un
+# hilo mientras siguen los pasos 2 y 3 (--export-bg)
+EXPORT_FORMATS = ("xlsx", "csv", "parquet", "feather")
+EXPORT_FORMAT = "xlsx"
+EXPORT_BACKGROUND = False
+
+# Detección de duplicados (--dedupe, --dedupe-keys, --dedupe-block, --dedupe-umbral):
+#   exacto      filas idénticas en las columnas clave (por defecto todas)
+#   normalizado además ignora espacios y mayúsculas en el texto
+#   difuso      además filas que coinciden en al menos DEDUPE_UMBRAL de las claves
+#               (se comparan solo vecinas dentro de cada bloque, ver _find_duplicates)
+DEDUPE_MODES = ("exacto", "normalizado", "difuso")
+DEDUPE_MODE = "exacto"
+DEDUPE_KEYS = None     # columnas o roles; None = todas las columnas
+DEDUPE_BLOCK = None    # columnas o roles del bloque en modo difuso; None = edad y género
+DEDUPE_UMBRAL = 0.9
+
+# Motor para leer .xlsx (--excel-engine); None = calamine si está instalado, si no openpyxl
+READ_ENGINE = None
+
+# Subir este número cada vez que cambien las reglas de limpieza de run_calidad,
+# así la caché generada con reglas anteriores deja de considerarse válida.
+CLEANING_VERSION = "2"
+
+# Alias de columnas por rol (edad, género, ...); ver _load_schema
+SCHEMA_PATH = PROJECT_DIR / "esquema_columnas.toml"
+
+def configurar_rutas(project_dir: Path, data_path: Path = None, report_dir: Path = None) -> None:
+    """Apunta el proyecto (datos/, reportes/, resumen) a otra carpeta.
+
+    Lo usan el benchmark y el modo por lotes para trabajar fuera del repo.
+    """
+    global PROJECT_DIR, DATA_PATH, REPORT_DIR, FIG_DIR, CLEAN_CSV_PATH, CACHE_DIR, MANIFEST_PATH
+    PROJECT_DIR = Path(project_dir).resolve()
+    DATA_PATH   = Path(data_path).resolve() if data_path else PROJECT_DIR / "datos" / "JEFAB_2024.xlsx"
+    REPORT_DIR  = Path(report_dir).resolve() if report_dir else PROJECT_DIR / "reportes"
+    FIG_DIR     = REPORT_DIR / "figs"
+    CLEAN_CSV_PATH = REPORT_DIR / "datos_limpios.csv"
+    CACHE_DIR   = REPORT_DIR / ".cache"
+    MANIFEST_PATH = REPORT_DIR / ".manifest.json"
+
+# ---------------------------------------------------------------------
+# Instrumentación (--profile): tiempo de pared, CPU, memoria y filas por etapa
+# ---------------------------------------------------------------------
+# Perfil activo; con None las etapas no miden nada (coste casi nulo)
+PERFIL = None
+
+def _rss_pico_mb():
+    """Pico de memoria residente del proceso en MB (None si no se puede medir)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+def _filas_de(res):
+    """Número de filas del resultado de una etapa (DataFrame o tupla que empieza por uno)."""
+    if isinstance(res, tuple) and res:
+        res = res[0]
+    return len(res) if isinstance(res, (pd.DataFrame, pd.Series)) else None
+
+class _Perfil:
+    """Intervalos medidos por etapa; se exportan a JSON, Markdown y Chrome trace.
+
+    Con memoria=True también se registra el pico de tracemalloc de cada etapa
+    (más lento: cada asignación de Python queda trazada).
+    """
+
+    def __init__(self, memoria: bool = False):
+        self.memoria = memoria
+        self.spans = []
+        self._pila = []
+        self.t0 = time.perf_counter()
+        self.pid = os.getpid()
+        self.tid = threading.get_native_id()
+        if memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def etapa(self, nombre: str, filas: int = None):
+        span = {"nombre": nombre, "padre": self._pila[-1]["nombre"] if self._pila else None,
+                "nivel": len(self._pila), "pid": self.pid, "tid": self.tid, "filas": filas}
+        if self.memoria:
+            # el pico de tracemalloc es global: se guarda el acumulado del padre antes de reiniciarlo
+            actual, pico = tracemalloc.get_traced_memory()
+            if self._pila:
+                self._pila[-1]["_pico"] = max(self._pila[-1]["_pico"], pico)
+            tracemalloc.reset_peak()
+            span["_base"], span["_pico"] = actual, actual
+        self._pila.append(span)
+        c0, t0 = time.process_time(), time.perf_counter()
+        try:
+            yield span
+        finally:
+            span["inicio"] = t0
+            span["dur_s"] = time.perf_counter() - t0
+            span["cpu_s"] = time.process_time() - c0
+            span["rss_mb"] = _rss_pico_mb()
+            self._pila.pop()
+            if self.memoria:
+                pico = max(span.pop("_pico"), tracemalloc.get_traced_memory()[1])
+                span["py_pico_mb"] = round((pico - span.pop("_base")) / (1 << 20), 2)
+                if self._pila:
+                    self._pila[-1]["_pico"] = max(self._pila[-1]["_pico"], pico)
+            self.spans.append(span)
+
+    def agregar(self, spans: list) -> None:
+        """Añade intervalos medidos en otros procesos (p. ej. figuras dibujadas en el pool)."""
+        padre = self._pila[-1]["nombre"] if self._pila else None
+        for span in spans:
+            self.spans.append(dict(span, padre=padre, nivel=len(self._pila)))
+
+    def exportar(self, directorio: Path) -> list:
+        """Escribe perfil.json, perfil.md y perfil_chrome.json; devuelve sus rutas."""
+        directorio.mkdir(parents=True, exist_ok=True)
+        total = time.perf_counter() - self.t0
+        spans = sorted(self.spans, key=lambda s: (s["inicio"], -s["dur_s"]))
+        registros = [{**s, "inicio_s": round(s["inicio"] - self.t0, 6)} for s in spans]
+        for r in registros:
+            del r["inicio"]
+
+        json_path = directorio / "perfil.json"
+        json_path.write_text(json.dumps({
+            "generado": dt.datetime.now().isoformat(timespec="seconds"),
+            "total_s": round(total, 6), "memoria": self.memoria, "etapas": registros,
+        }, indent=2, ensure_ascii=False), encoding="utf-8")
+
+        # Chrome trace (chrome://tracing o Perfetto): un carril por proceso/hilo
+        eventos = [{"name": "process_name", "ph": "M", "pid": pid, "tid": pid,
+                    "args": {"name": "principal" if pid == self.pid else f"figuras {pid}"}}
+                   for pid in sorted({s["pid"] for s in spans})]
+        for s in spans:
+            eventos.append({
+                "name": s["nombre"], "cat": s["padre"] or "etapa", "ph": "X",
+                "ts": round((s["inicio"] - self.t0) * 1e6, 1), "dur": round(s["dur_s"] * 1e6, 1),
+                "pid": s["pid"], "tid": s.get("tid", s["pid"]),
+                "args": {k: s[k] for k in ("filas", "cpu_s", "rss_mb", "py_pico_mb") if s.get(k) is not None},
+            })
+        chrome_path = directorio / "perfil_chrome.json"
+        chrome_path.write_text(json.dumps({"traceEvents": eventos, "displayTimeUnit": "ms"}),
+                               encoding="utf-8")
+
+        filas = []
+        for s in spans:
+            fila = {
+                "Etapa": "· " * s["nivel"] + s["nombre"],
+                "Filas": s["filas"] if s["filas"] is not None else "",
+                "Pared (s)": f"{s['dur_s']:.3f}",
+                "CPU (s)": f"{s['cpu_s']:.3f}",
+                "% total": f"{100 * s['dur_s'] / total:.1f}" if total else "",
+                "RSS pico (MB)": s["rss_mb"] if s["rss_mb"] is not None else "",
+            }
+            if self.memoria:
+                fila["Pico Python (MB)"] = s.get("py_pico_mb", "")
+            if s["pid"] != self.pid:
+                fila["Etapa"] += f" (pid {s['pid']})"
+            filas.append(fila)
+        md_path = directorio / "perfil.md"
+        md_path.write_text("\n".join([
+            "# Perfil de ejecución",
+            f"_Generado: {dt.datetime.now():%Y-%m-%d %H:%M}_",
+            "",
+            f"- Tiempo total: **{total:.3f} s**",
+            f"- Pico de RSS del proceso principal: **{_rss_pico_mb()} MB**",
+            f"- Traza para chrome://tracing o Perfetto: `{chrome_path.name}`",
+            "",
+            _df_to_md(pd.DataFrame(filas)) if filas else "_No se registraron etapas._",
+        ]), encoding="utf-8")
+        return [json_path, md_path, chrome_path]
+
+def _etapa(nombre: str, filas: int = None):
+    """Mide el bloque 'with' como una etapa del perfil (no hace nada sin --profile)."""
+    if PERFIL is None:
+        return contextlib.nullcontext({})
+    return PERFIL.etapa(nombre, filas)
+
+def _perfilado(nombre: str):
+    """Decorador: mide cada llamada como etapa y toma las filas del resultado."""
+    def deco(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if PERFIL is None:
+                return func(*args, **kwargs)
+            with PERFIL.etapa(nombre) as span:
+                res = func(*args, **kwargs)
+                if span["filas"] is None:
+                    span["filas"] = _filas_de(res)
+                return res
+        return wrapper
+    return deco
 
 # ---------------------------------------------------------------------
 # Utilidades
@@ -47,92 +289,664 @@ def _df_to_md(df: pd.DataFrame, index=False) -> str:
     except Exception:
         return "```\n" + df.to_string(index=index) + "\n```"
 
-def _find_col(df: pd.DataFrame, candidates):
-    """Devuelve el nombre real de la primera columna existente en 'candidates'."""
-    for c in candidates:
-        if c in df.columns:
-            return c
-    norm = {str(col).strip().lower(): col for col in df.columns}
-    for c in candidates:
-        key = str(c).strip().lower()
-        if key in norm:
-            return norm[key]
-    return None
-
-def _is_yes(x) -> bool:
-    if pd.isna(x):
-        return False
-    s = str(x).strip().upper()
-    return s in {"SI", "SÍ", "YES", "TRUE", "1", "Y", "X"}
+def _clean_path(fmt: str = None) -> Path:
+    """Ruta de la exportación del dataset limpio en el formato dado (por defecto EXPORT_FORMAT)."""
+    return REPORT_DIR / f"datos_limpios.{fmt or EXPORT_FORMAT}"
 
 def _prefer_clean_path() -> Path:
-    """Usa el dataset limpio si existe; si no, el original."""
-    return CLEAN_PATH if CLEAN_PATH.exists() else DATA_PATH
+    """Usa la exportación más reciente del dataset limpio si existe; si no, el original."""
+    found = [p for p in map(_clean_path, EXPORT_FORMATS) if p.exists()]
+    return max(found, key=lambda p: p.stat().st_mtime_ns) if found else DATA_PATH
 
-def _normalize_colnames(cols) -> list:
-    """Arregla caracteres raros y espacios múltiples en nombres de columnas."""
-    fixed = []
-    for c in cols:
-        s = str(c)
-        s = (s.replace("Ã¡", "á").replace("Ã©", "é").replace("Ã­", "í")
-               .replace("Ã³", "ó").replace("Ãº", "ú").replace("Ã±", "ñ")
-               .replace("Ã", "Á").replace("â", "a").replace("€", "€")
-               .replace("", "").replace("", "-").replace("¢", ""))
-        s = re.sub(r"\s+", " ", s)
-        s = s.strip()
-        fixed.append(s)
-    return fixed
-
-def _normalize_text_series(s: pd.Series) -> pd.Series:
-    """Trim + upper sobre series de texto."""
-    return s.astype(str).str.strip().str.upper()
+def _excel_engine() -> str:
+    if READ_ENGINE:
+        return READ_ENGINE
+    try:
+        import python_calamine  # noqa: F401
+        return "calamine"
+    except ImportError:
+        return "openpyxl"
+
+def _read_table(path: Path, columns=None, dtype: dict = None) -> pd.DataFrame:
+    """Lee .csv, .parquet, .feather o .xlsx según la extensión.
+
+    Opcionalmente solo 'columns' y con 'dtype' aplicado al parsear (csv/xlsx)
+    o justo después de leer (parquet/feather).
+    """
+    with _etapa(f"leer:{path.name}") as span:
+        suffix = path.suffix.lower()
+        if suffix == ".csv":
+            df = pd.read_csv(path, usecols=columns, dtype=dtype)
+        elif suffix in (".parquet", ".feather"):
+            read = pd.read_parquet if suffix == ".parquet" else pd.read_feather
+            df = read(path, columns=columns)
+            if dtype:
+                df = df.astype(dtype)
+        else:
+            df = pd.read_excel(path, usecols=columns, dtype=dtype, engine=_excel_engine())
+        span["filas"] = len(df)
+    return df
+
+def _read_header(path: Path) -> list:
+    """Nombres de columnas del archivo sin cargar los datos."""
+    if path.suffix.lower() == ".xlsx":
+        # solo la primera fila con el iterador read-only de openpyxl (no carga la hoja);
+        # la primera hoja, como read_excel, aunque el libro se haya guardado con otra activa
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            return list(next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), ()))
+        finally:
+            wb.close()
+    if path.suffix == ".feather":
+        import pyarrow.ipc as ipc
+        with ipc.open_file(path) as reader:
+            return list(reader.schema.names)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        return list(pq.read_schema(path).names)
+    if path.suffix == ".pkl":
+        return list(pd.read_pickle(path).columns)
+    if path.suffix.lower() == ".csv":
+        return list(pd.read_csv(path, nrows=0).columns)
+    return list(pd.read_excel(path, nrows=0, engine=_excel_engine()).columns)
+
+def _rel(path: Path) -> str:
+    """Ruta relativa al proyecto (para los reportes); absoluta si está fuera de él."""
+    try:
+        return path.relative_to(PROJECT_DIR).as_posix()
+    except ValueError:
+        return path.as_posix()
 
 # ---------------------------------------------------------------------
-# PASO 1: CALIDAD (con limpieza)
+# Caché del dataset limpio (Feather/Arrow si hay pyarrow; si no, pickle)
 # ---------------------------------------------------------------------
-def run_calidad(save_md: bool = True) -> dict:
-    _ensure_dirs()
-    # Leer original SIEMPRE para limpiar desde la fuente
-    df = pd.read_excel(DATA_PATH)
+def _has_pyarrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
 
-    # ---------------- LIMPIEZA ----------------
-    # 1) Renombrar columnas con caracteres extraños y espacios
-    df.columns = _normalize_colnames(df.columns)
+def _file_hash(path: Path) -> str:
+    """SHA-256 del contenido del archivo (memorizado mientras no cambie tamaño/mtime)."""
+    st = Path(path).stat()
+    return _file_hash_cached(str(path), st.st_mtime_ns, st.st_size)
+
+@lru_cache(maxsize=32)
+def _file_hash_cached(path: str, mtime_ns: int, size: int, block: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _cache_key(source: Path) -> str:
+    """Clave de caché: hash del archivo fuente y del esquema + versión de las reglas de limpieza.
+
+    El esquema decide qué columna es cada rol (qué edad se imputa, qué texto se
+    normaliza), así que cambiarlo invalida la caché igual que cambiar la fuente.
+    """
+    return f"{_file_hash(source)[:16]}-{_file_hash(SCHEMA_PATH)[:8]}-v{CLEANING_VERSION}"
+
+def _cache_path(key: str) -> Path:
+    ext = "feather" if _has_pyarrow() else "pkl"
+    return CACHE_DIR / f"datos_limpios_{key}.{ext}"
+
+@_perfilado("escribir_cache")
+def _write_cache(df: pd.DataFrame, source: Path) -> Path:
+    """Guarda el dataset limpio (índice por defecto) en la caché y borra entradas anteriores."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = _cache_path(_cache_key(source))
+
+    for old in CACHE_DIR.glob("datos_limpios_*"):
+        if old != path:
+            old.unlink()
+    if path.suffix == ".feather":
+        # sin compresión para poder leerlo con memory-map
+        df.to_feather(path, compression="uncompressed")
+    else:
+        df.to_pickle(path)
+    return path
+
+def _valid_cache_path(source: Path):
+    """Ruta de la caché vigente para 'source', o None."""
+    if not source.exists():
+        return None
+    path = _cache_path(_cache_key(source))
+    return path if path.exists() else None
+
+@_perfilado("leer_cache")
+def _read_cache(source: Path, columns=None):
+    """Devuelve (df, ruta) si hay caché válida para 'source'; si no, (None, None)."""
+    path = _valid_cache_path(source)
+    if path is None:
+        return None, None
+    if path.suffix == ".feather":
+        import pyarrow.feather as feather
+        df = feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    else:
+        df = pd.read_pickle(path)
+        if columns is not None:
+            df = df[columns]
+    return df, path
+
+@_perfilado("cargar_limpio")
+def _load_clean():
+    """Carga el dataset limpio (caché válida > exportación limpia > original).
+
+    Solo se leen las columnas con rol en el esquema. Devuelve (df, ruta, roles,
+    número total de columnas del archivo).
+    """
+    path = _valid_cache_path(DATA_PATH)
+    if path is None:
+        path = _prefer_clean_path()
+        df, cols, total_cols = _read_dataset(path, roles_only=True)
+        return df, path, cols, total_cols
+    header = _read_header(path)
+    cols = _resolve_roles(header)
+    usecols = [c for c in header if c in set(cols.values())]
+    df, _ = _read_cache(DATA_PATH, columns=usecols)
+    return df, path, cols, len(header)
 
-    # 2) Eliminar duplicados
-    dup_count_before = int(df.duplicated().sum())
-    df = df.drop_duplicates()
-    dup_count_after = int(df.duplicated().sum())
+# ---------------------------------------------------------------------
+# Exportación del dataset limpio (xlsx / csv / parquet / feather)
+# ---------------------------------------------------------------------
+def _xlsx_column(s: pd.Series) -> list:
+    """Valores de la columna como objetos de Python; faltantes -> None (celda vacía)."""
+    return s.astype(object).where(s.notna(), None).tolist()
 
-    # 3) Imputar faltantes en EDAD con la media (si existe)
-    edad_col = _find_col(df, ["EDAD2", "EDAD", "Edad"])
-    mean_age = None
-    if edad_col:
-        df[edad_col] = pd.to_numeric(df[edad_col], errors="coerce")
-        if df[edad_col].isna().any():
-            mean_age = int(round(df[edad_col].mean()))
-            df[edad_col] = df[edad_col].fillna(mean_age)
+def _write_xlsx(df: pd.DataFrame, path: Path, block: int = 10_000) -> None:
+    """xlsx con xlsxwriter en modo constant_memory: se escribe fila a fila y
+    solo la fila actual queda en memoria. Sin xlsxwriter se usa openpyxl."""
+    try:
+        import xlsxwriter
+    except ImportError:
+        df.to_excel(path, index=False)
+        return
+    # el texto de la encuesta se guarda tal cual (sin convertir a fórmulas ni enlaces);
+    # las fechas llevan formato, si no Excel las muestra como número de serie
+    wb = xlsxwriter.Workbook(str(path), {
+        "constant_memory": True, "strings_to_formulas": False, "strings_to_urls": False,
+        "default_date_format": "yyyy-mm-dd",
+    })
+    try:
+        ws = wb.add_worksheet()
+        ws.write_row(0, 0, [str(c) for c in df.columns])
+        for start in range(0, len(df), block):
+            part = df.iloc[start:start + block]
+            for i, row in enumerate(zip(*(_xlsx_column(part[c]) for c in part.columns)), start + 1):
+                ws.write_row(i, 0, row)
+    finally:
+        wb.close()
+
+_EXPORT_WRITERS = {
+    "xlsx": _write_xlsx,
+    "csv": lambda df, path: df.to_csv(path, index=False),
+    "parquet": lambda df, path: df.to_parquet(path, index=False),
+    "feather": lambda df, path: df.reset_index(drop=True).to_feather(path),
+}
+
+def _check_export_format(fmt: str) -> None:
+    if fmt not in _EXPORT_WRITERS:
+        raise ValueError(f"Formato de exportación desconocido: {fmt} (use {', '.join(EXPORT_FORMATS)})")
+    if fmt in ("parquet", "feather") and not _has_pyarrow():
+        raise ValueError(f"Exportar a {fmt} requiere pyarrow.")
+
+def _write_export(df: pd.DataFrame, path: Path) -> None:
+    """Escribe a un temporal y lo renombra al final: una exportación
+    interrumpida nunca queda en disco como si estuviera completa."""
+    tmp = path.with_name(f".{path.stem}.tmp{path.suffix}")
+    try:
+        _EXPORT_WRITERS[path.suffix[1:]](df, tmp)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+def _run_export_task(df: pd.DataFrame, path: Path) -> dict:
+    """Exporta en el hilo de fondo y devuelve su intervalo medido (para --profile)."""
+    c0, t0 = time.thread_time(), time.perf_counter()
+    _write_export(df, path)
+    return {"nombre": f"escribir:{path.name} (fondo)", "padre": None, "nivel": 0,
+            "pid": os.getpid(), "tid": threading.get_native_id(), "filas": len(df), "inicio": t0,
+            "dur_s": time.perf_counter() - t0, "cpu_s": time.thread_time() - c0,
+            "rss_mb": _rss_pico_mb()}
+
+_EXPORT_POOL = None
+
+def _export_clean(df: pd.DataFrame, path: Path, background: bool = False):
+    """Exporta el dataset limpio; con background=True devuelve el Future del hilo.
+
+    El DataFrame no debe modificarse mientras se escribe (los pasos 2 y 3 solo
+    lo leen). Hay que esperar el Future con _wait_export antes de terminar.
+    """
+    if not background:
+        with _etapa(f"escribir:{path.name}", filas=len(df)):
+            _write_export(df, path)
+        return None
+    global _EXPORT_POOL
+    if _EXPORT_POOL is None:
+        _EXPORT_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="exportar")
+    return _EXPORT_POOL.submit(_run_export_task, df, path)
+
+def _wait_export(job) -> None:
+    """Espera una exportación en segundo plano (si la hay) y propaga su error."""
+    if job is None:
+        return
+    with _etapa("esperar_exportacion"):
+        span = job.result()
+    if PERFIL is not None:
+        PERFIL.agregar([span])
 
-    # 4) Normalizar texto en columnas clave (si existen)
-    genero_col = _find_col(df, ["GENERO", "GÉNERO", "SEXO", "Sexo", "Genero"])
-    if genero_col:
-        df[genero_col] = _normalize_text_series(df[genero_col])
-        df[genero_col] = df[genero_col].replace({
-            "M": "MASCULINO", "F": "FEMENINO",
-            "HOMBRE": "MASCULINO", "MUJER": "FEMENINO"
-        })
+# ---------------------------------------------------------------------
+# Manifiesto para re-ejecuciones incrementales
+# ---------------------------------------------------------------------
+def _hash_inputs(*parts) -> str:
+    """Hash estable de una mezcla de Series/DataFrames, rutas y valores simples."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, (pd.Series, pd.DataFrame)):
+            h.update(pd.util.hash_pandas_object(part, index=False).to_numpy().tobytes())
+            names = [part.name] if isinstance(part, pd.Series) else list(part.columns)
+            h.update(repr(names).encode())
+        else:
+            h.update(repr(part).encode())
+        h.update(b"\x00")
+    return h.hexdigest()
+
+@lru_cache(maxsize=1)
+def _code_hash() -> str:
+    """Hash de este script: si cambia el código, figuras y reportes se regeneran."""
+    try:
+        return _file_hash(Path(__file__))
+    except (NameError, OSError):
+        return "sin-archivo"
+
+class _Manifest:
+    """Registro en disco de los hashes de entrada de cada paso/figura y sus salidas."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        try:
+            self.entries = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def fresh(self, key: str, h: str, outputs) -> bool:
+        """True si 'key' ya se generó con las mismas entradas y sus salidas siguen en disco."""
+        entry = self.entries.get(key)
+        return (INCREMENTAL and entry is not None and entry["hash"] == h
+                and all(Path(o).exists() for o in outputs))
+
+    def record(self, key: str, h: str, outputs, meta=None):
+        self.entries[key] = {"hash": h, "outputs": [str(o) for o in outputs], "meta": meta}
+
+    def meta(self, key: str):
+        return self.entries[key].get("meta")
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(
+            json.dumps(self.entries, indent=1, ensure_ascii=False,
+                       default=lambda o: o.item() if hasattr(o, "item") else str(o)),
+            encoding="utf-8")
+
+_MANIFEST = None
+
+def _manifest() -> _Manifest:
+    global _MANIFEST
+    if _MANIFEST is None or _MANIFEST.path != MANIFEST_PATH:
+        _MANIFEST = _Manifest(MANIFEST_PATH)
+    return _MANIFEST
+
+def _fig_path(nombre: str) -> Optional[Path]:
+    """Ruta de una figura en FIG_DIR, o None si las figuras están desactivadas (--no-figs)."""
+    return FIG_DIR / nombre if FIGURAS else None
+
+def _render_needed(fig: Path, h: str) -> bool:
+    """True si la figura hay que (re)dibujarla; la registra con el hash de sus entradas."""
+    key = f"fig:{fig.name}"
+    h = _hash_inputs(h, _code_hash())
+    if _manifest().fresh(key, h, [fig]):
+        return False
+    _manifest().record(key, h, [fig])
+    return True
+
+_TIMESTAMP_PREFIXES = ("_Actualizado:", "_Última ejecución:")
+
+def _write_md(md_path: Path, text: str) -> bool:
+    """Escribe el reporte solo si cambió algo más que la marca de tiempo."""
+    body = "\n".join(line for line in text.splitlines() if not line.startswith(_TIMESTAMP_PREFIXES))
+    key = f"md:{md_path.name}"
+    h = _hash_inputs(body)
+    if _manifest().fresh(key, h, [md_path]):
+        return False
+    with _etapa(f"escribir:{md_path.name}"):
+        md_path.write_text(text, encoding="utf-8")
+    _manifest().record(key, h, [md_path])
+    return True
+
+# ---------------------------------------------------------------------
+# Esquema: roles de columnas y sus alias (esquema_columnas.toml / .yaml)
+# ---------------------------------------------------------------------
+REQUIRED_ROLES = ("edad", "genero", "ec", "grado", "hijos", "conv")
+ROLE_TYPES = ("numerico", "categorico", "si_no")
+
+class Roles(TypedDict):
+    """Nombre real de la columna de cada rol (None si el archivo no la tiene)."""
+    edad: Optional[str]
+    genero: Optional[str]
+    ec: Optional[str]
+    grado: Optional[str]
+    hijos: Optional[str]
+    conv: Optional[str]
+
+def _load_schema() -> dict:
+    """Roles del esquema: {rol: {"alias": [...], "tipo": ...}}."""
+    st = SCHEMA_PATH.stat()
+    return _load_schema_cached(str(SCHEMA_PATH), st.st_mtime_ns)
+
+@lru_cache(maxsize=4)
+def _load_schema_cached(path: str, mtime_ns: int) -> dict:
+    path = Path(path)
+    if path.suffix.lower() in (".yaml", ".yml"):
+        import yaml
+        raw = yaml.safe_load(path.read_text(encoding="utf-8")) or {}
+    else:
+        try:
+            import tomllib
+        except ModuleNotFoundError:   # Python < 3.11
+            import tomli as tomllib
+        raw = tomllib.loads(path.read_text(encoding="utf-8"))
+    roles = raw.get("roles", {})
+    missing = [r for r in REQUIRED_ROLES if r not in roles]
+    if missing:
+        raise ValueError(f"El esquema {path.name} no define los roles: {', '.join(missing)}")
+    for role, spec in roles.items():
+        if not spec.get("alias"):
+            raise ValueError(f"El rol '{role}' del esquema {path.name} no tiene alias.")
+        if spec.get("tipo", "categorico") not in ROLE_TYPES:
+            raise ValueError(f"Tipo desconocido para el rol '{role}': {spec['tipo']}")
+    return roles
+
+@lru_cache(maxsize=4)
+def _alias_index(path: str, mtime_ns: int) -> tuple:
+    """Índices alias -> (rol, prioridad): uno exacto y otro sin mayúsculas/espacios."""
+    exact, loose = {}, {}
+    for role, spec in _load_schema_cached(path, mtime_ns).items():
+        for prio, alias in enumerate(spec["alias"]):
+            exact.setdefault(alias, (role, prio))
+            loose.setdefault(str(alias).strip().lower(), (role, prio))
+    return exact, loose
+
+def _resolve_roles(columns) -> Roles:
+    """Nombre real de la columna para cada rol del esquema (o None).
+
+    Recorre las columnas una sola vez contra un índice de alias; gana la
+    coincidencia exacta y, dentro de ella, el alias listado primero. El
+    resultado se memoriza por firma de columnas.
+    """
+    if isinstance(columns, pd.DataFrame):
+        columns = columns.columns
+    st = SCHEMA_PATH.stat()
+    return dict(_resolve_roles_cached(tuple(columns), str(SCHEMA_PATH), st.st_mtime_ns))
+
+@lru_cache(maxsize=64)
+def _resolve_roles_cached(columns: tuple, schema_path: str, mtime_ns: int) -> Roles:
+    exact, loose = _alias_index(schema_path, mtime_ns)
+    best = {}
+    for col in columns:
+        for tier, index, key in ((0, exact, col), (1, loose, str(col).strip().lower())):
+            if key not in index:
+                continue
+            role, prio = index[key]
+            if role not in best or (tier, prio) < best[role][:2]:
+                best[role] = (tier, prio, col)
+    roles = _load_schema_cached(schema_path, mtime_ns)
+    return {role: (best[role][2] if role in best else None) for role in roles}
+
+# ---------------------------------------------------------------------
+# Lectura del dataset: columnas por rol y tipos aplicados al leer
+# ---------------------------------------------------------------------
+def _compact_numeric(s: pd.Series) -> pd.Series:
+    """Numérico (texto inválido -> faltante) en el entero más chico que lo
+    represente: de numpy si no hay faltantes, anulable si los hay. float64 si
+    tiene decimales o no hay valores."""
+    x = pd.to_numeric(s, errors="coerce")
+    v = x.dropna()
+    if v.empty or not (v % 1 == 0).all():
+        return x if x.dtype == "float64" else x.astype("float64")
+    lo, hi = v.min(), v.max()
+    for dtype, nullable in (("uint8", "UInt8"), ("uint16", "UInt16"), ("int16", "Int16"),
+                            ("int32", "Int32"), ("int64", "Int64")):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return x.astype(dtype if len(v) == len(x) else nullable)
+    return x.astype("float64")
+
+def _optimize_dtypes(df: pd.DataFrame, max_card: float = 0.5) -> pd.DataFrame:
+    """Tipos compactos (in place): enteros pequeños para los numéricos enteros,
+    categoría para el texto de baja cardinalidad (valores distintos <= max_card
+    de las filas) y cadenas Arrow para el texto libre (si hay pyarrow).
+
+    Las columnas de objetos con tipos mezclados (números y texto) se dejan igual.
+    """
+    arrow = _has_pyarrow()
+    n = max(len(df), 1)
+    for c in df.columns:
+        s = df[c]
+        if pd.api.types.is_bool_dtype(s) or isinstance(s.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_numeric_dtype(s):
+            df[c] = _compact_numeric(s)
+            continue
+        is_str = isinstance(s.dtype, pd.StringDtype)
+        if not is_str and not (pd.api.types.is_object_dtype(s)
+                               and pd.api.types.infer_dtype(s, skipna=True) == "string"):
+            continue
+        if s.nunique() <= max_card * n:
+            df[c] = s.astype("category")
+        elif arrow and not is_str:
+            df[c] = s.astype("string[pyarrow]")
+    return df
+
+@_perfilado("leer_dataset")
+def _read_dataset(path: Path, roles_only: bool = False):
+    """Lee 'path' con nombres de columna ya normalizados y tipos por rol.
+
+    Los roles categóricos del esquema se leen directamente como categoría y
+    los numéricos se pasan a enteros pequeños, así los pasos siguientes no
+    vuelven a materializar esas columnas. Con roles_only=True solo se leen las
+    columnas con rol. Devuelve (df, roles, número de columnas del archivo).
+    """
+    header = _read_header(path)
+    names = _normalize_colnames(header)
+    cols = _resolve_roles(names)
+    raw = {}
+    for name, h in zip(names, header):
+        raw.setdefault(name, h)
+    schema = _load_schema()
+    tipos = {col: schema[role].get("tipo", "categorico") for role, col in cols.items() if col}
+    usecols = [raw[c] for c in tipos] if roles_only else None
+    df = _read_table(path, columns=usecols,
+                     dtype={raw[c]: "category" for c, t in tipos.items() if t == "categorico"} or None)
+    df.columns = _normalize_colnames(df.columns)
+    for c, t in tipos.items():
+        if t == "numerico":
+            df[c] = _compact_numeric(df[c])
+    return df, cols, len(header)
 
-    ec_col = _find_col(df, ["ESTADO_CIVIL", "Estado civil", "ESTADOCIVIL"])
+# ---------------------------------------------------------------------
+# Contexto compartido entre pasos
+# ---------------------------------------------------------------------
+@dataclass
+class Contexto:
+    """Dataset cargado una sola vez + roles de columnas ya resueltos.
+
+    Los pasos reciben el mismo objeto y leen ``df`` sin copiarlo ni modificarlo.
+    """
+    df: pd.DataFrame
+    data_path: Path
+    cols: Roles = field(default_factory=dict)
+    total_cols: int = None   # columnas del archivo (df puede traer solo las de los roles)
+    filtro: str = None       # expresión del segmento (ver subconjunto); None = toda la población
+    _col_hashes: dict = field(default_factory=dict, repr=False)
+    _norm_cache: dict = field(default_factory=dict, repr=False)
+    _padre: Contexto = field(default=None, repr=False)
+    _pos: np.ndarray = field(default=None, repr=False)
+
+    def norm(self, role: str, upper: bool = True) -> pd.Series:
+        """Columna del rol normalizada (categórica); se calcula una vez por contexto."""
+        key = (role, upper)
+        if key not in self._norm_cache:
+            if self._padre is not None:
+                # segmento: se toman sus filas de la columna ya normalizada del padre
+                s = self._padre.norm(role, upper).take(self._pos)
+                self._norm_cache[key] = s.cat.remove_unused_categories()
+            else:
+                self._norm_cache[key] = _normalize_text_series(self.df[self.cols[role]], upper=upper)
+        return self._norm_cache[key]
+
+    def subconjunto(self, mascara: np.ndarray, filtro: str = None) -> Contexto:
+        """Contexto con las filas de 'mascara' (p. ej. de IndiceSegmentos.mascara).
+
+        No relee la fuente ni copia el DataFrame entero: solo toma esas filas de
+        las columnas con rol, y las columnas normalizadas salen de las del padre.
+        """
+        pos = np.flatnonzero(mascara)
+        cols_rol = list(dict.fromkeys(c for c in self.cols.values() if c))
+        df = pd.DataFrame({c: self.df[c].take(pos) for c in cols_rol})
+        return Contexto(df, self.data_path, self.cols, self.total_cols, filtro=filtro, _padre=self, _pos=pos)
+
+    def si_no(self, role: str):
+        """(booleano anulable, no clasificados) de un rol sí/no; se calcula una vez."""
+        key = (role, "si_no")
+        if key not in self._norm_cache:
+            self._norm_cache[key] = _code_yes_no(self.df[self.cols[role]])
+        return self._norm_cache[key]
+
+    def hash_cols(self, *cols) -> str:
+        """Hash del contenido de las columnas dadas (cada columna se hashea una sola vez)."""
+        for c in cols:
+            if c not in self._col_hashes:
+                self._col_hashes[c] = _hash_inputs(self.df[c])
+        return _hash_inputs(*(self._col_hashes[c] for c in cols))
+
+    def __post_init__(self):
+        if not self.cols:
+            self.cols = _resolve_roles(self.df)
+        if self.total_cols is None:
+            self.total_cols = len(self.df.columns)
+        edad_col = self.cols.get("edad")
+        if edad_col and not pd.api.types.is_numeric_dtype(self.df[edad_col]):
+            self.df[edad_col] = pd.to_numeric(self.df[edad_col], errors="coerce")
+
+def _contexto_limpio() -> Contexto:
+    """Contexto a partir del dataset limpio (caché, xlsx limpio u original)."""
+    df, path, cols, total_cols = _load_clean()
+    return Contexto(df, path, cols, total_cols)
+
+# Secuencias de mojibake (UTF-8 leído como latin-1/cp1252) y su reemplazo.
+# Una sola regex con las alternativas más largas primero = una pasada por nombre.
+_MOJIBAKE_MAP = {
+    "Ã¡": "á", "Ã©": "é", "Ã\u00ad": "í", "Ã³": "ó", "Ãº": "ú", "Ã±": "ñ",
+    "Ã": "Á", "â": "a",
+}
+_MOJIBAKE_RE = re.compile("|".join(re.escape(k) for k in sorted(_MOJIBAKE_MAP, key=len, reverse=True)))
+# Caracteres sueltos que se borran o cambian (tabla de traducción, también una pasada)
+_COLNAME_TABLE = str.maketrans({"\u009d": "", "\u0096": "-", "¢": ""})
+_SPACES_RE = re.compile(r"\s+")
+
+def _repair_mojibake(s: str) -> str:
+    """Deshace el doble encoding (UTF-8 leído como cp1252/latin-1) si el texto lo tiene."""
+    if not any(ch in s for ch in "ÃÂâ"):
+        return s
+    for enc in ("cp1252", "latin-1"):
+        try:
+            return s.encode(enc).decode("utf-8")
+        except UnicodeError:
+            continue
+    return s
+
+@lru_cache(maxsize=4096)
+def _normalize_colname(name: str) -> str:
+    s = _repair_mojibake(name)
+    s = _MOJIBAKE_RE.sub(lambda m: _MOJIBAKE_MAP[m.group(0)], s)
+    s = s.translate(_COLNAME_TABLE)
+    return _SPACES_RE.sub(" ", s).strip()
+
+def _normalize_colnames(cols) -> list:
+    """Arregla caracteres raros y espacios múltiples en nombres de columnas."""
+    return [_normalize_colname(str(c)) for c in cols]
+
+def _recategorizar(cat: pd.Series, nuevas, sort: bool = False) -> pd.Series:
+    """Serie categórica con cada categoría de 'cat' reemplazada por la de 'nuevas'
+    en la misma posición; las que quedan iguales se fusionan y los faltantes siguen
+    faltantes (también si la columna no tiene ningún valor)."""
+    new_codes, uniques = pd.factorize(nuevas, sort=sort)
+    codes = cat.cat.codes.to_numpy()
+    valid = codes >= 0
+    out = np.full_like(codes, -1)
+    out[valid] = new_codes[codes[valid]]
+    return pd.Series(pd.Categorical.from_codes(out, categories=uniques), index=cat.index, name=cat.name)
+
+def _normalize_text_series(s: pd.Series, mapping: dict = None, upper: bool = True) -> pd.Series:
+    """Trim + upper (+ mapeo opcional) sobre series de texto.
+
+    Se trabaja sobre las categorías: cada valor distinto se normaliza una sola vez
+    y el resultado es categórico. Los faltantes se mantienen como faltantes.
+    """
+    cat = s if isinstance(s.dtype, pd.CategoricalDtype) else s.astype("category")
+    norm = cat.cat.categories.astype(str).str.strip()
+    if upper:
+        norm = norm.str.upper()
+    if mapping:
+        norm = norm.map(lambda v: mapping.get(v, v))
+    # varias categorías pueden quedar iguales ("m" y "M "): se fusionan
+    return _recategorizar(cat, norm, sort=True)
+
+# Respuestas sí/no reconocidas (ya normalizadas: sin espacios y en mayúsculas)
+YES_VALUES = {"SI", "SÍ", "YES", "TRUE", "1", "Y", "X"}
+NO_VALUES  = {"NO", "FALSE", "0", "N"}
+
+def _code_responses(s: pd.Series, codes: dict, dtype: str = "Int8"):
+    """Codifica respuestas de encuesta (sí/no, Likert...) con un diccionario texto -> valor.
+
+    Se normaliza y clasifica cada valor distinto una sola vez (categorías) y el
+    resultado se arma con los códigos, sin llamar a Python por fila. Devuelve la
+    serie codificada (anulable: <NA> = faltante o no reconocido) y cuántos valores
+    no faltantes no se pudieron clasificar.
+    """
+    cat = _normalize_text_series(s)
+    known = pd.array([codes.get(c) for c in cat.cat.categories], dtype=dtype)
+    idx = cat.cat.codes.to_numpy()
+    out = known.take(idx, allow_fill=True)     # código -1 (faltante) -> <NA>
+    unclassified = int(((idx >= 0) & out.isna()).sum())
+    return pd.Series(out, index=s.index, name=s.name), unclassified
+
+def _code_yes_no(s: pd.Series):
+    """Sí/no como booleano anulable (True / False / <NA>) + conteo de no clasificados."""
+    codes = {**{v: True for v in YES_VALUES}, **{v: False for v in NO_VALUES}}
+    return _code_responses(s, codes, dtype="boolean")
+
+GENERO_MAP = {
+    "M": "MASCULINO", "F": "FEMENINO",
+    "HOMBRE": "MASCULINO", "MUJER": "FEMENINO"
+}
+
+def _normalize_role_text(df: pd.DataFrame, cols: dict) -> None:
+    """Normaliza (in place) el texto de género y estado civil; sirve para un bloque o el total."""
+    genero_col = cols["genero"]
+    if genero_col:
+        df[genero_col] = _normalize_text_series(df[genero_col], mapping=GENERO_MAP)
+    ec_col = cols["ec"]
     if ec_col:
         df[ec_col] = _normalize_text_series(df[ec_col])
 
-    # 5) Guardar dataset limpio
-    df.to_excel(CLEAN_PATH, index=False)
-
-    # ---------------- MÉTRICAS/REPORTE ----------------
-    missing = df.isna().sum()
-    pct = (missing / len(df) * 100).round(2)
-    top_missing = (
+def _top_missing(missing: pd.Series, n_rows: int) -> pd.DataFrame:
+    """Top 10 de columnas con más faltantes a partir de los conteos por columna."""
+    pct = (missing / max(n_rows, 1) * 100).round(2)
+    return (
         pd.DataFrame({
             "Columna": missing.index,
             "Datos_Faltantes": missing.values,
@@ -142,110 +956,832 @@ def run_calidad(save_md: bool = True) -> dict:
         .head(10)
         .reset_index(drop=True)
     )
-    tipos = df.dtypes.value_counts().to_dict()
+
+# ---------------------------------------------------------------------
+# Figuras: tareas independientes con la API orientada a objetos de
+# matplotlib (sin estado global de pyplot). Cada tarea recibe datos ya
+# agregados, así se pueden repartir entre procesos.
+# ---------------------------------------------------------------------
+def _new_axes(figsize):
+    # Figure sin pyplot no necesita backend de GUI: savefig usa Agg para PNG
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize)
+    return fig, fig.add_subplot()
+
+def _save_fig(fig: Figure, path) -> None:
+    fig.tight_layout()
+    fig.savefig(path, dpi=120)
+
+def _fig_hist(path, counts, edges, title, xlabel, ylabel, figsize=(9,5)):
+    """Histograma a partir de conteos por intervalo (np.histogram), sin los datos."""
+    fig, ax = _new_axes(figsize)
+    ax.stairs(counts, edges, fill=True)
+    ax.stairs(counts, edges, color="black")   # borde de la silueta
+    ax.vlines(edges[1:-1], 0, np.minimum(counts[:-1], counts[1:]), color="black", linewidth=1)
+    ax.set_title(title); ax.set_xlabel(xlabel); ax.set_ylabel(ylabel)
+    _save_fig(fig, path)
+
+def _fig_bar(path, labels, values, title, xlabel, ylabel, figsize=(10,5), rotation=45):
+    fig, ax = _new_axes(figsize)
+    ax.bar([str(l) for l in labels], values, edgecolor="black")
+    ax.set_title(title); ax.set_xlabel(xlabel); ax.set_ylabel(ylabel)
+    ax.tick_params(axis="x", labelrotation=rotation)
+    if rotation not in (0, 90):
+        for t in ax.get_xticklabels():
+            t.set_horizontalalignment("right")
+    _save_fig(fig, path)
+
+def _fig_stacked(path, index, columns, values, title, xlabel, ylabel, legend_title, figsize=(11,6)):
+    """Barras apiladas: 'values' es una matriz len(index) x len(columns)."""
+    fig, ax = _new_axes(figsize)
+    values = np.asarray(values, dtype=float)
+    bottom = np.zeros(len(index))
+    labels = [str(i) for i in index]
+    for j, col in enumerate(columns):
+        ax.bar(labels, values[:, j], bottom=bottom, edgecolor="black", label=str(col))
+        bottom += values[:, j]
+    ax.set_title(title); ax.set_xlabel(xlabel); ax.set_ylabel(ylabel)
+    ax.tick_params(axis="x", labelrotation=45)
+    for t in ax.get_xticklabels():
+        t.set_horizontalalignment("right")
+    ax.legend(title=legend_title, bbox_to_anchor=(1.02, 1), loc="upper left")
+    _save_fig(fig, path)
+
+def _fig_box(path, stats, title, xlabel, ylabel, figsize=(10,6)):
+    """Boxplot a partir de estadísticos ya calculados (Histograma.caja), sin los datos."""
+    fig, ax = _new_axes(figsize)
+    ax.bxp(stats)
+    ax.set_xticks(range(1, len(stats) + 1), [str(st["label"]) for st in stats], rotation=45, ha="right")
+    ax.set_title(title); ax.set_xlabel(xlabel); ax.set_ylabel(ylabel)
+    _save_fig(fig, path)
+
+_SIN_FIGURAS = "_Figuras desactivadas en esta ejecución (`--no-figs`)._"
+
+def _run_render_task(task):
+    """Dibuja una figura y devuelve su intervalo medido (para --profile, también en el pool)."""
+    func, kwargs = task
+    c0, t0 = time.process_time(), time.perf_counter()
+    func(**kwargs)
+    return {"nombre": f"figura:{Path(kwargs['path']).name}", "padre": None, "nivel": 0,
+            "pid": os.getpid(), "filas": None, "inicio": t0,
+            "dur_s": time.perf_counter() - t0, "cpu_s": time.process_time() - c0,
+            "rss_mb": _rss_pico_mb()}
+
+def _render_figs(tasks: list) -> None:
+    """Dibuja las tareas (func, kwargs) en serie o en un pool de JOBS procesos.
+
+    Ambas rutas ejecutan el mismo código, así que los PNG resultantes son idénticos.
+    """
+    if not tasks:
+        return
+    with _etapa("figuras"):
+        if JOBS > 1 and len(tasks) > 1:
+            from concurrent.futures import ProcessPoolExecutor  # multiprocessing solo si hace falta
+            with ProcessPoolExecutor(max_workers=min(JOBS, len(tasks))) as ex:
+                spans = list(ex.map(_run_render_task, tasks))
+        else:
+            spans = [_run_render_task(task) for task in tasks]
+        if PERFIL is not None:
+            PERFIL.agregar(spans)
+
+# ---------------------------------------------------------------------
+# Duplicados: un hash por fila sobre las columnas clave
+# ---------------------------------------------------------------------
+def _resolve_keys(keys, df: pd.DataFrame, cols: Roles) -> list:
+    """Columnas clave a partir de nombres de columna o de rol (None = todas)."""
+    if not keys:
+        return None
+    out = []
+    for k in keys:
+        col = k if k in df.columns else cols.get(k)
+        if col is None or col not in df.columns:
+            raise ValueError(f"Columna o rol desconocido para duplicados: {k}")
+        out.append(col)
+    return out
+
+def _valor_tipado(v) -> str:
+    """Valor como texto con su tipo: 1 y 1.0 quedan iguales, 1 y "1" no (como en duplicated)."""
+    if isinstance(v, (int, float, np.number)) and not isinstance(v, bool):
+        return f"num:{float(v)!r}"
+    return f"{type(v).__name__}:{v}"
+
+def _dedupe_norm(s: pd.Series, normalize: bool, stable: bool = False) -> pd.Series:
+    """Valores para el hash de una columna.
+
+    El texto pasa a categoría (se hashea cada valor distinto una vez) y, si
+    'normalize', sin espacios repetidos ni mayúsculas. Con 'stable' los
+    numéricos van a float64 para que 1 y 1.0 den el mismo hash aunque el dtype
+    cambie entre bloques.
+    """
+    if pd.api.types.is_numeric_dtype(s) and not isinstance(s.dtype, pd.CategoricalDtype):
+        return s.astype("float64") if stable else s
+    cat = s if isinstance(s.dtype, pd.CategoricalDtype) else s.astype("category")
+    if not normalize:
+        cats = cat.cat.categories
+        if cats.dtype == object and cats.inferred_type != "string":
+            # Tipos mezclados: hash_pandas_object pasa los objetos a texto y 1 y "1"
+            # darían el mismo hash; se hashea cada valor distinto junto con su tipo
+            return _recategorizar(cat, pd.Index([_valor_tipado(v) for v in cats]))
+        return cat
+    norm = cat.cat.categories.astype(str).str.replace(_SPACES_RE, " ", regex=True).str.strip().str.upper()
+    return _recategorizar(cat, norm)
+
+def _row_hashes(df: pd.DataFrame, keys: list, normalize: bool = False, stable: bool = False) -> np.ndarray:
+    """Un hash de 64 bits por fila sobre las columnas clave."""
+    frame = pd.DataFrame({c: _dedupe_norm(df[c], normalize, stable) for c in keys}, index=df.index)
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+@dataclass
+class Duplicados:
+    """Resultado de _find_duplicates: se conserva la primera fila de cada grupo."""
+    keep: np.ndarray      # máscara de filas que se conservan
+    grupo: np.ndarray     # grupo de duplicados de cada fila (-1 = sin duplicados)
+    modo: str
+    claves: list          # None = todas las columnas
+
+    @property
+    def eliminados(self) -> int:
+        return int((~self.keep).sum())
+
+    def grupos(self, top: int = 20, offset: int = 2) -> pd.DataFrame:
+        """Los 'top' grupos más grandes con sus filas en la fuente (fila = posición + offset)."""
+        pos = np.flatnonzero(self.grupo >= 0)
+        if not len(pos):
+            return pd.DataFrame(columns=["Grupo", "Registros", "Filas en la fuente"])
+        g = pd.Series(pos + offset).groupby(self.grupo[pos], sort=False)
+        filas = g.agg(lambda x: ", ".join(map(str, x.iloc[:10])) + (" …" if len(x) > 10 else ""))
+        out = pd.DataFrame({"Registros": g.size(), "Filas en la fuente": filas})
+        out = out.sort_values("Registros", ascending=False, kind="stable").head(top)
+        out.insert(0, "Grupo", range(1, len(out) + 1))
+        return out.reset_index(drop=True)
+
+def _union_find(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Raíz (menor índice) de cada una de las n filas tras unir los pares (a, b).
+
+    Solo se recorren las filas que aparecen en algún par.
+    """
+    nodes, inv = np.unique(np.concatenate([a, b]), return_inverse=True)
+    parent = list(range(len(nodes)))
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for x, y in zip(inv[:len(a)].tolist(), inv[len(a):].tolist()):
+        rx, ry = find(x), find(y)
+        if rx != ry:
+            parent[max(rx, ry)] = min(rx, ry)
+    root = np.arange(n)
+    root[nodes] = nodes[[find(x) for x in range(len(nodes))]]
+    return root
+
+@_perfilado("duplicados")
+def _find_duplicates(df: pd.DataFrame, keys: list = None, modo: str = "exacto", block: list = None,
+                     umbral: float = 0.9, ventana: int = 10) -> Duplicados:
+    """Marca duplicados con un solo hash por fila (modos exacto/normalizado).
+
+    En modo difuso cada columna clave normalizada se factoriza a códigos, las
+    filas se ordenan por (bloque, códigos) y cada una se compara solo con las
+    'ventana' siguientes del mismo bloque (vecindario ordenado): dos filas son
+    casi duplicadas si coinciden en al menos 'umbral' de las claves. Los pares
+    se unen en grupos; nunca se comparan todas contra todas.
+    """
+    claves, keys = keys, keys or list(df.columns)
+    n = len(df)
+    if modo != "difuso":
+        h = pd.Series(_row_hashes(df, keys, normalize=modo == "normalizado"))
+        keep = ~h.duplicated().to_numpy()
+        grupo = np.full(n, -1, dtype=np.int64)
+        dup = h.duplicated(keep=False).to_numpy()
+        grupo[dup] = pd.factorize(h[dup])[0]
+        return Duplicados(keep, grupo, modo, claves)
+
+    codes = np.column_stack([pd.factorize(_dedupe_norm(df[c], True), use_na_sentinel=False)[0]
+                             for c in keys]) if n else np.empty((0, len(keys)), dtype=np.int64)
+    bloque = (pd.factorize(pd.Series(_row_hashes(df, block, normalize=True)))[0]
+              if block else np.zeros(n, dtype=np.int64))
+    order = np.lexsort(tuple(codes[:, ::-1].T) + (bloque,))
+    sc, sb = codes[order], bloque[order]
+    need = int(np.ceil(umbral * len(keys)))
+    pa, pb = [], []
+    for off in range(1, min(ventana, max(n - 1, 0)) + 1):
+        same = (sb[off:] == sb[:-off]) & ((sc[off:] == sc[:-off]).sum(axis=1) >= need)
+        idx = np.flatnonzero(same)
+        pa.append(order[idx]); pb.append(order[idx + off])
+    a = np.concatenate(pa) if pa else np.empty(0, dtype=np.int64)
+    b = np.concatenate(pb) if pb else np.empty(0, dtype=np.int64)
+    root = _union_find(n, a, b) if len(a) else np.arange(n)
+    keep = root == np.arange(n)
+    size = np.bincount(root, minlength=n)
+    grupo = np.where(size[root] > 1, pd.factorize(root)[0], -1)
+    return Duplicados(keep, grupo, modo, claves)
+
+# ---------------------------------------------------------------------
+# PASO 1: CALIDAD (con limpieza)
+# ---------------------------------------------------------------------
+@_perfilado("calidad")
+def run_calidad(save_md: bool = True, export: bool = True, export_format: str = None,
+                background: bool = None) -> dict:
+    """Paso 1: limpieza + caché columnar + exportación opcional del dataset limpio.
+
+    La exportación usa 'export_format' (por defecto EXPORT_FORMAT); con
+    'background' (por defecto EXPORT_BACKGROUND) se escribe en un hilo y el
+    resultado trae el Future en "export" (esperar con _wait_export).
+    """
+    _ensure_dirs()
+    fmt = export_format or EXPORT_FORMAT
+    background = EXPORT_BACKGROUND if background is None else background
+    clean_path = None
+    if export:
+        _check_export_format(fmt)
+        clean_path = _clean_path(fmt)
+    # Si la fuente y las reglas de limpieza no cambiaron, se reutiliza la caché
+    man = _manifest()
+    stage_hash = _hash_inputs(_file_hash(DATA_PATH), _file_hash(SCHEMA_PATH), CLEANING_VERSION,
+                              export and fmt, save_md, DEDUPE_MODE, DEDUPE_KEYS, DEDUPE_BLOCK, DEDUPE_UMBRAL)
+    expected = [_cache_path(_cache_key(DATA_PATH))] + ([clean_path] if export else []) \
+        + ([REPORT_DIR / "calidad_datos.md"] if save_md else [])
+    if man.fresh("calidad", stage_hash, expected):
+        meta = man.meta("calidad")
+        df, cache_file = _read_cache(DATA_PATH)
+        return {
+            "top_missing": pd.DataFrame(meta["top_missing"]),
+            "duplicados_eliminados": meta["duplicados_eliminados"],
+            "duplicados_restantes": meta["duplicados_restantes"],
+            "grupos_duplicados": pd.DataFrame(meta.get("grupos_duplicados", [])),
+            "edad_imputada_media": meta["edad_imputada_media"],
+            "tipos": meta["tipos"],
+            "memoria": meta.get("memoria"),
+            "clean_file": clean_path,
+            "cache_file": cache_file,
+            "ctx": Contexto(df, cache_file),
+            "export": None,
+            "omitido": True,
+        }
+
+    # ---------------- LIMPIEZA ----------------
+    # Leer original SIEMPRE para limpiar desde la fuente. El lector ya aplica
+    # 1) nombres de columnas sin caracteres extraños ni espacios y los tipos por
+    # rol (categorías para el texto de baja cardinalidad, enteros para la edad)
+    df, cols, _ = _read_dataset(DATA_PATH)
+
+    # 2) Eliminar duplicados (un hash por fila; se conserva la primera de cada grupo)
+    block = DEDUPE_BLOCK or [r for r in ("edad", "genero") if cols[r]]
+    dups = _find_duplicates(df, _resolve_keys(DEDUPE_KEYS, df, cols), DEDUPE_MODE,
+                            block=_resolve_keys(block, df, cols) if block else None, umbral=DEDUPE_UMBRAL)
+    grupos_dup = dups.grupos()
+    dup_count_before = dups.eliminados
+    dup_count_after = 0   # tras quitar los grupos no queda ninguna fila repetida en las claves
+    if dup_count_before:
+        df = df[dups.keep].reset_index(drop=True)
+
+    # 3) Imputar faltantes en EDAD con la media (si existe)
+    edad_col = cols["edad"]
+    mean_age = None
+    if edad_col:
+        with _etapa("imputar_edad", filas=len(df)):
+            df[edad_col] = pd.to_numeric(df[edad_col], errors="coerce")
+            if df[edad_col].isna().any():
+                mean_age = int(round(df[edad_col].mean()))
+                df[edad_col] = df[edad_col].fillna(mean_age)
+
+    # 4) Normalizar texto en columnas clave (si existen)
+    with _etapa("normalizar_texto", filas=len(df)):
+        _normalize_role_text(df, cols)
+
+    # 5) Tipos compactos (enteros pequeños, categorías, cadenas Arrow)
+    with _etapa("optimizar_tipos", filas=len(df)):
+        mem_antes = int(df.memory_usage(deep=True).sum())
+        _optimize_dtypes(df)
+        mem_despues = int(df.memory_usage(deep=True).sum())
+        memoria = {"antes_mb": round(mem_antes / 2**20, 2), "despues_mb": round(mem_despues / 2**20, 2)}
+
+    # 6) Guardar dataset limpio (caché columnar; la exportación es opcional)
+    cache_file = _write_cache(df, DATA_PATH)
+    export_job = _export_clean(df, clean_path, background) if export else None
+
+    # ---------------- MÉTRICAS/REPORTE ----------------
+    with _etapa("metricas_calidad", filas=len(df)):
+        top_missing = _top_missing(df.isna().sum(), len(df))
+        tipos = df.dtypes.astype(str).value_counts().to_dict()
 
     if save_md:
-        md_path = REPORT_DIR / "calidad_datos.md"
-        md = [
-            "# Calidad de Datos (con limpieza aplicada)",
-            f"_Actualizado: {dt.datetime.now():%Y-%m-%d %H:%M}_",
+        _write_calidad_md(
+            dup_count_before, edad_col, mean_age, top_missing, tipos, memoria=memoria,
+            duplicados=(dups, grupos_dup),
+            salidas=[
+                f"- **Dataset limpio** en caché: `{_rel(cache_file)}`",
+                (f"- **Dataset limpio** exportado a: `{_rel(clean_path)}`" if export
+                 else "- No se exportó el dataset limpio."),
+            ],
+        )
+
+    man.record("calidad", stage_hash, expected, meta={
+        "top_missing": top_missing.to_dict("records"),
+        "duplicados_eliminados": dup_count_before,
+        "duplicados_restantes": dup_count_after,
+        "grupos_duplicados": grupos_dup.to_dict("records"),
+        "edad_imputada_media": mean_age,
+        "tipos": tipos,
+        "memoria": memoria,
+    })
+    man.save()
+
+    return {
+        "top_missing": top_missing,
+        "duplicados_eliminados": dup_count_before,
+        "duplicados_restantes": dup_count_after,
+        "grupos_duplicados": grupos_dup,
+        "edad_imputada_media": mean_age,
+        "tipos": tipos,
+        "memoria": memoria,
+        "clean_file": clean_path,
+        "cache_file": cache_file,
+        "ctx": Contexto(df, cache_file, cols),
+        "export": export_job,
+    }
+
+def _write_calidad_md(dup_count, edad_col, mean_age, top_missing, tipos, salidas, notas=(), memoria=None,
+                      duplicados=None):
+    md_path = REPORT_DIR / "calidad_datos.md"
+    md = [
+        "# Calidad de Datos (con limpieza aplicada)",
+        f"_Actualizado: {dt.datetime.now():%Y-%m-%d %H:%M}_",
+        *notas,
+        "",
+        "## Limpieza aplicada",
+        "- **Nombres de columnas** normalizados (se corrigieron caracteres extraños y espacios).",
+        f"- **Duplicados eliminados:** {dup_count}",
+        (f"- **Imputación de edades faltantes** con la media en `{edad_col}` (**{mean_age}** años)." if mean_age is not None
+         else "- No se imputó edad (columna no encontrada o sin faltantes)."),
+        "- **Género** y **estado civil** convertidos a mayúsculas y estandarizados.",
+        *salidas,
+        "",
+        "## Datos faltantes después de limpieza",
+        _df_to_md(top_missing, index=False),
+        "",
+        "## Tipos de datos",
+        "\n".join([f"- **{k}**: {v}" for k, v in tipos.items()]),
+    ]
+    if memoria:
+        antes, despues = memoria["antes_mb"], memoria["despues_mb"]
+        md += [
             "",
-            "## Limpieza aplicada",
-            "- **Nombres de columnas** normalizados (se corrigieron caracteres extraños y espacios).",
-            f"- **Duplicados eliminados:** {dup_count_before}",
-            (f"- **Imputación de edades faltantes** con la media en `{edad_col}` (**{mean_age}** años)." if mean_age is not None
-             else "- No se imputó edad (columna no encontrada o sin faltantes)."),
-            "- **Género** y **estado civil** convertidos a mayúsculas y estandarizados.",
-            f"- **Dataset limpio** guardado en: `{CLEAN_PATH.relative_to(PROJECT_DIR).as_posix()}`",
+            "## Memoria del dataset limpio",
+            f"- Antes de optimizar tipos: **{antes} MB**",
+            f"- Después (enteros pequeños, categorías, cadenas Arrow): **{despues} MB**"
+            + (f" (**{antes / despues:.1f}x** menos)" if despues else ""),
+        ]
+    if duplicados is not None:
+        dups, grupos = duplicados
+        claves = ", ".join(f"`{c}`" for c in dups.claves) if dups.claves else "todas las columnas"
+        md += [
             "",
-            "## Datos faltantes después de limpieza",
-            _df_to_md(top_missing, index=False),
+            "## Grupos de duplicados",
+            f"- Modo: **{dups.modo}**; columnas clave: {claves}.",
+            "- Se conserva la primera fila de cada grupo.",
             "",
-            "## Tipos de datos",
-            "\n".join([f"- **{k}**: {v}" for k, v in tipos.items()]),
+            (_df_to_md(grupos) if not grupos.empty else "_No se encontraron duplicados._"),
         ]
-        md_path.write_text("\n\n".join(md), encoding="utf-8")
+    _write_md(md_path, "\n\n".join(md))
+
+# ---------------------------------------------------------------------
+# PASO 1 (modo por bloques): para archivos que no caben en memoria
+# ---------------------------------------------------------------------
+def _iter_chunks(path: Path, chunksize: int):
+    """Lee un .csv o .xlsx en bloques de 'chunksize' filas (columnas ya normalizadas)."""
+    if path.suffix.lower() == ".csv":
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            chunk.columns = _normalize_colnames(chunk.columns)
+            yield chunk
+        return
+
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)   # la misma hoja que lee read_excel
+        header = _normalize_colnames(next(rows, ()))
+        buf = []
+        for row in rows:
+            buf.append(row)
+            if len(buf) >= chunksize:
+                yield pd.DataFrame(buf, columns=header)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=header)
+    finally:
+        wb.close()
+
+def _dedupe_mask(chunk: pd.DataFrame, seen: set, keys: list = None, normalize: bool = False) -> np.ndarray:
+    """Filas del bloque que no se han visto antes (hash por fila + conjunto de hashes vistos)."""
+    hashes = _row_hashes(chunk, keys or list(chunk.columns), normalize, stable=True)
+    keep = ~pd.Series(hashes).duplicated().to_numpy()
+    for i in np.flatnonzero(keep):
+        h = int(hashes[i])
+        if h in seen:
+            keep[i] = False
+        else:
+            seen.add(h)
+    return keep
+
+def _tipos_numericos(tipos: dict, chunk: pd.DataFrame) -> dict:
+    """Acumula por columna si es numérica en todos los bloques donde trae valores.
+
+    Una columna queda como texto en cuanto un bloque trae algo no numérico, así
+    el tipo no depende del primer bloque y ningún valor se pierde al escribir.
+    """
+    for c in chunk.columns:
+        if chunk[c].notna().any():
+            tipos[c] = tipos.get(c, True) and pd.api.types.is_numeric_dtype(chunk[c])
+    return tipos
+
+class _ChunkWriter:
+    """Escribe bloques limpios a CSV y, si hay pyarrow, a la caché Feather (Arrow IPC).
+
+    Se escribe en archivos temporales que solo reemplazan a los definitivos en
+    commit(), tras el último bloque; discard() los borra si la limpieza falla.
+    """
+
+    def __init__(self, source: Path, numeric: dict):
+        self.csv_path = CLEAN_CSV_PATH
+        self.cache_path = None
+        self._ipc = None
+        self._schema = None
+        self._numeric = numeric
+        self._tmp = {}
+        if _has_pyarrow():
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            self.cache_path = _cache_path(_cache_key(source))
+        for path in (self.csv_path, self.cache_path):
+            if path is not None:
+                self._tmp[path] = path.with_name(f".{path.stem}.tmp{path.suffix}")
+                self._tmp[path].unlink(missing_ok=True)
+
+    def _conform(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        # Tipos fijados con todos los bloques (_tipos_numericos): numérico -> float64, resto -> texto
+        out = {}
+        for c in chunk.columns:
+            if self._numeric.get(c, False):
+                out[c] = pd.to_numeric(chunk[c]).astype("float64")
+            else:
+                out[c] = chunk[c].astype("string")
+        return pd.DataFrame(out)
+
+    def write(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        chunk = self._conform(chunk)
+        csv_tmp = self._tmp[self.csv_path]
+        first = not csv_tmp.exists()
+        chunk.to_csv(csv_tmp, mode="a", header=first, index=False)
+        if self.cache_path is not None:
+            import pyarrow as pa
+            if self._ipc is None:
+                self._schema = pa.schema([
+                    (c, pa.float64() if self._numeric.get(c, False) else pa.string()) for c in chunk.columns
+                ])
+                self._ipc = pa.ipc.new_file(str(self._tmp[self.cache_path]), self._schema)
+            self._ipc.write_table(pa.Table.from_pandas(chunk, schema=self._schema, preserve_index=False))
+        return chunk
+
+    def _close_ipc(self):
+        if self._ipc is not None:
+            self._ipc.close()
+            self._ipc = None
+
+    def commit(self):
+        """Cierra los temporales y los pone en su lugar (solo tras el último bloque)."""
+        self._close_ipc()
+        if self.cache_path is not None:
+            for old in CACHE_DIR.glob("datos_limpios_*"):
+                old.unlink()
+        for path, tmp in self._tmp.items():
+            os.replace(tmp, path)
+
+    def discard(self):
+        """Borra los temporales: una limpieza interrumpida no deja caché ni CSV truncados."""
+        self._close_ipc()
+        for tmp in self._tmp.values():
+            tmp.unlink(missing_ok=True)
+
+@_perfilado("calidad_por_bloques")
+def run_calidad_stream(chunksize: int, save_md: bool = True) -> dict:
+    """Paso 1 por bloques: memoria acotada por 'chunksize' (más el conjunto de hashes vistos).
+
+    Hace dos pasadas sobre la fuente: la primera marca duplicados y acumula la media
+    de edad; la segunda limpia cada bloque y lo escribe de forma incremental.
+    """
+    _ensure_dirs()
+    if DEDUPE_MODE == "difuso":
+        raise ValueError("El modo de duplicados 'difuso' no está disponible por bloques "
+                         "(use 'exacto' o 'normalizado').")
+
+    # Pasada 1: duplicados (hash por fila) + acumulador de edad
+    seen = set()
+    keys = None
+    numeric = {}
+    keep_masks = []
+    dup_count = 0
+    edad_sum, edad_n = 0.0, 0
+    cols = None
+    with _etapa("pasada_duplicados") as span:
+        for chunk in _iter_chunks(DATA_PATH, chunksize):
+            if cols is None:
+                cols = _resolve_roles(chunk)
+                keys = _resolve_keys(DEDUPE_KEYS, chunk, cols)
+            keep = _dedupe_mask(chunk, seen, keys, normalize=DEDUPE_MODE == "normalizado")
+            _tipos_numericos(numeric, chunk.loc[keep])
+            keep_masks.append(keep)
+            dup_count += int((~keep).sum())
+            if cols["edad"]:
+                edad = pd.to_numeric(chunk.loc[keep, cols["edad"]], errors="coerce")
+                edad_sum += float(edad.sum())
+                edad_n += int(edad.count())
+        span["filas"] = sum(len(k) for k in keep_masks)
+    del seen
+    if cols is None:
+        raise ValueError(f"El archivo {DATA_PATH} no tiene filas.")
+
+    # Pasada 2: limpieza por bloque + escritura incremental
+    edad_col = cols["edad"]
+    if edad_col:
+        numeric[edad_col] = True   # se convierte a número (e imputa) en cada bloque
+    mean_age = None
+    missing = None
+    n_rows = 0
+    tipos = {}
+    # La caché se reescribe por otra vía: la limpieza en memoria deja de estar vigente,
+    # y se guarda ya para que una ejecución interrumpida no la deje marcada como vigente
+    _manifest().entries.pop("calidad", None)
+    _manifest().save()
+    writer = _ChunkWriter(DATA_PATH, numeric)
+    with _etapa("pasada_limpieza") as span:
+        try:
+            for chunk, keep in zip(_iter_chunks(DATA_PATH, chunksize), keep_masks):
+                chunk = chunk.loc[keep].reset_index(drop=True)
+                if edad_col:
+                    chunk[edad_col] = pd.to_numeric(chunk[edad_col], errors="coerce")
+                    if chunk[edad_col].isna().any() and edad_n:
+                        mean_age = int(round(edad_sum / edad_n))
+                        chunk[edad_col] = chunk[edad_col].fillna(mean_age)
+                _normalize_role_text(chunk, cols)
+                chunk = writer.write(chunk)
+                n_rows += len(chunk)
+                missing = chunk.isna().sum() if missing is None else missing + chunk.isna().sum()
+                tipos = chunk.dtypes.astype(str).value_counts().to_dict()
+        except BaseException:
+            writer.discard()
+            raise
+        writer.commit()
+        span["filas"] = n_rows
+
+    top_missing = _top_missing(missing, n_rows)
+    if save_md:
+        salidas = [f"- **Dataset limpio** exportado por bloques a: `{_rel(writer.csv_path)}`"]
+        if writer.cache_path is not None:
+            salidas.insert(0, f"- **Dataset limpio** en caché: `{_rel(writer.cache_path)}`")
+        _write_calidad_md(
+            dup_count, edad_col, mean_age, top_missing, tipos, salidas,
+            notas=[f"_Modo por bloques: {chunksize} filas por bloque, {len(keep_masks)} bloques._"],
+        )
+    _manifest().save()
 
     return {
         "top_missing": top_missing,
-        "duplicados_eliminados": dup_count_before,
-        "duplicados_restantes": dup_count_after,
+        "duplicados_eliminados": dup_count,
+        "duplicados_restantes": 0,
         "edad_imputada_media": mean_age,
         "tipos": tipos,
-        "clean_file": CLEAN_PATH
+        "clean_file": writer.csv_path,
+        "cache_file": writer.cache_path or writer.csv_path,
     }
 
+# ---------------------------------------------------------------------
+# Estadísticos combinables: se calculan por bloque, archivo o proceso y se
+# unen (unir) con el mismo resultado que sobre todos los registros juntos
+# ---------------------------------------------------------------------
+@dataclass
+class Momentos:
+    """Conteo, media y suma de cuadrados centrada (Welford/Chan) + mínimo y máximo."""
+    n: int = 0
+    media: float = float("nan")
+    m2: float = 0.0
+    minimo: float = float("nan")
+    maximo: float = float("nan")
+
+    @classmethod
+    def desde(cls, x) -> "Momentos":
+        x = np.asarray(x, dtype="float64")
+        x = x[~np.isnan(x)]
+        if not x.size:
+            return cls()
+        media = x.mean()
+        return cls(x.size, float(media), float(((x - media) ** 2).sum()), float(x.min()), float(x.max()))
+
+    def unir(self, otro: "Momentos") -> "Momentos":
+        if not otro.n:
+            return self
+        if not self.n:
+            return otro
+        n = self.n + otro.n
+        delta = otro.media - self.media
+        return Momentos(n, self.media + delta * otro.n / n,
+                        self.m2 + otro.m2 + delta ** 2 * self.n * otro.n / n,
+                        min(self.minimo, otro.minimo), max(self.maximo, otro.maximo))
+
+    @property
+    def varianza(self) -> float:
+        return self.m2 / (self.n - 1) if self.n > 1 else np.nan
+
+@dataclass
+class Histograma:
+    """Conteos exactos por valor distinto, para uno o varios grupos (filas).
+
+    Con edades enteras el número de valores distintos es pequeño, así que
+    cuantiles, medianas, modas e histogramas salen exactos sin guardar los
+    registros. 'conteos' tiene forma (grupos, valores).
+    """
+    valores: np.ndarray
+    conteos: np.ndarray
+
+    @classmethod
+    def desde(cls, x, grupos=None, k: int = 1) -> "Histograma":
+        """Histograma de 'x' (faltantes fuera); 'grupos' son códigos 0..k-1 (-1 = fuera)."""
+        x = np.asarray(x, dtype="float64")
+        g = np.zeros(len(x), dtype=np.int64) if grupos is None else np.asarray(grupos, dtype=np.int64)
+        ok = ~np.isnan(x) & (g >= 0)
+        x, g = x[ok], g[ok]
+        if x.size and np.array_equal(x, np.round(x)) and x.max() - x.min() < 1 << 16:
+            # enteros en un rango corto (edades, hijos): bincount denso, sin ordenar
+            lo = x.min()
+            ids = (x - lo).astype(np.int64)
+            nv = int(ids.max()) + 1
+            conteos = np.bincount(g * nv + ids, minlength=k * nv).reshape(k, nv)
+            usados = conteos.sum(axis=0) > 0
+            return cls((lo + np.arange(nv))[usados], conteos[:, usados])
+        valores, ids = np.unique(x, return_inverse=True)
+        nv = len(valores)
+        return cls(valores, np.bincount(g * nv + ids, minlength=k * nv).reshape(k, nv))
+
+    def unir(self, otro: "Histograma") -> "Histograma":
+        """Suma de dos histogramas con los mismos grupos."""
+        valores = np.union1d(self.valores, otro.valores)
+        conteos = np.zeros((self.conteos.shape[0], len(valores)), dtype=np.int64)
+        conteos[:, np.searchsorted(valores, self.valores)] += self.conteos
+        conteos[:, np.searchsorted(valores, otro.valores)] += otro.conteos
+        return Histograma(valores, conteos)
+
+    @property
+    def n(self) -> np.ndarray:
+        return self.conteos.sum(axis=1)
+
+    def suma(self) -> np.ndarray:
+        return self.conteos @ self.valores
+
+    def cuantil(self, q: float) -> np.ndarray:
+        """Cuantil q por grupo, con la interpolación lineal de pandas/numpy (NaN si está vacío)."""
+        n = self.n
+        cum = np.cumsum(self.conteos, axis=1)
+        out = np.full(len(n), np.nan)
+        for i in np.flatnonzero(n):
+            h = (n[i] - 1) * q
+            lo, hi = np.searchsorted(cum[i], [np.floor(h), np.ceil(h)], side="right")
+            a, b = self.valores[lo], self.valores[hi]
+            out[i] = a + (h - np.floor(h)) * (b - a)
+        return out
+
+    def minimo(self) -> np.ndarray:
+        return np.array([self.valores[np.flatnonzero(c)[0]] if c.any() else np.nan for c in self.conteos])
+
+    def maximo(self) -> np.ndarray:
+        return np.array([self.valores[np.flatnonzero(c)[-1]] if c.any() else np.nan for c in self.conteos])
+
+    def por_intervalos(self, bins) -> np.ndarray:
+        """Conteos por grupo en los intervalos [bins[j], bins[j+1]) (como _age_bins)."""
+        j = np.searchsorted(bins, self.valores, side="right") - 1
+        dentro = (j >= 0) & (j < len(bins) - 1)
+        out = np.zeros((self.conteos.shape[0], len(bins) - 1), dtype=np.int64)
+        np.add.at(out.T, j[dentro], self.conteos[:, dentro].T)
+        return out
+
+    def histograma(self, bins: int = 20, grupo: int = 0):
+        """(conteos, bordes) idénticos a np.histogram(datos, bins) del grupo."""
+        usados = self.conteos[grupo] > 0
+        counts, edges = np.histogram(self.valores[usados], bins=bins, weights=self.conteos[grupo][usados])
+        return counts.astype(np.int64), edges
+
+    def caja(self, grupo: int = 0, whis: float = 1.5, label=None) -> dict:
+        """Estadísticos de caja del grupo, como matplotlib.cbook.boxplot_stats.
+
+        Los atípicos se devuelven una vez por valor distinto (el dibujo es el
+        mismo y su tamaño no crece con el número de registros).
+        """
+        c = self.conteos[grupo]
+        v = self.valores[c > 0]
+        sub = Histograma(v, c[c > 0][None, :])
+        q1, med, q3 = (sub.cuantil(q)[0] for q in (0.25, 0.5, 0.75))
+        iqr = q3 - q1
+        alto = v[v <= q3 + whis * iqr]
+        bajo = v[v >= q1 - whis * iqr]
+        whishi = q3 if not alto.size or alto.max() < q3 else alto.max()
+        whislo = q1 if not bajo.size or bajo.min() > q1 else bajo.min()
+        return {"label": label, "med": med, "q1": q1, "q3": q3, "iqr": iqr,
+                "whislo": whislo, "whishi": whishi, "mean": sub.suma()[0] / sub.n[0],
+                "fliers": v[(v < whislo) | (v > whishi)]}
+
+@dataclass
+class Conteo:
+    """Conteo por categoría (mapa valor -> registros) para modas combinables."""
+    conteos: dict = field(default_factory=dict)
+
+    @classmethod
+    def desde(cls, s: pd.Series) -> "Conteo":
+        vc = s.value_counts(dropna=True)
+        return cls({k: int(v) for k, v in vc.items() if v})
+
+    def unir(self, otro: "Conteo") -> "Conteo":
+        out = dict(self.conteos)
+        for k, v in otro.conteos.items():
+            out[k] = out.get(k, 0) + v
+        return Conteo(out)
+
+    def moda(self):
+        """Valor más frecuente; en empate el menor, como Series.mode().iloc[0]."""
+        if not self.conteos:
+            return None
+        top = max(self.conteos.values())
+        return min(k for k, v in self.conteos.items() if v == top)
+
 # ---------------------------------------------------------------------
 # PASO 2: DEMOGRAFÍA (usa dataset limpio si existe)
 # ---------------------------------------------------------------------
+AGE_BINS   = [0,18,25,35,45,55,65,120]
+AGE_LABELS = ["<18","18-24","25-34","35-44","45-54","55-64","65+"]
+
 def _age_bins(series: pd.Series):
-    bins = [0,18,25,35,45,55,65,120]
-    labels = ["<18","18-24","25-34","35-44","45-54","55-64","65+"]
-    return pd.cut(series, bins=bins, labels=labels, right=False, include_lowest=True)
+    return pd.cut(series, bins=AGE_BINS, labels=AGE_LABELS, right=False, include_lowest=True)
 
-def run_demografia(save_md: bool = True) -> dict:
+@_perfilado("demografia")
+def run_demografia(save_md: bool = True, ctx: Contexto = None) -> dict:
     _ensure_dirs()
-    data_path = _prefer_clean_path()
-    df = pd.read_excel(data_path)
+    ctx = ctx or _contexto_limpio()
+    df, data_path = ctx.df, ctx.data_path
 
-    edad_col   = _find_col(df, ["EDAD2", "EDAD", "Edad"])
-    genero_col = _find_col(df, ["GENERO", "GÉNERO", "SEXO", "Sexo", "Genero"])
-    grado_col  = _find_col(df, ["GRADO", "RANGO", "GRADO_MILITAR", "GRADO MILITAR", "Rango"])
+    edad_col   = ctx.cols["edad"]
+    genero_col = ctx.cols["genero"]
+    grado_col  = ctx.cols["grado"]
 
     if edad_col is None:
         raise ValueError("No se encontró una columna de edad (EDAD2/EDAD).")
 
-    df = df.copy()
-    df[edad_col] = pd.to_numeric(df[edad_col], errors="coerce")
-
     total_reg = len(df)
-    total_cols = len(df.columns)
-    edad_prom = df[edad_col].mean()
-    edad_min  = df[edad_col].min()
-    edad_max  = df[edad_col].max()
-
-    rangos = _age_bins(df[edad_col].dropna())
-    rango_mas_comun = rangos.value_counts().idxmax() if not rangos.empty else None
-
-    genero_counts = None
-    if genero_col:
-        genero_counts = df[genero_col].astype(str).str.strip().str.upper().value_counts(dropna=False)
-
-    grado_mas_frec = None
-    if grado_col:
-        m = df[grado_col].astype(str).str.strip().replace({"nan": pd.NA}).dropna().mode()
-        grado_mas_frec = None if m.empty else m.iloc[0]
-
-    # Figuras
-    fig1 = FIG_DIR / "demografia_hist_edades.png"
-    plt.figure(figsize=(9,5))
-    df[edad_col].dropna().plot(kind="hist", bins=20, edgecolor="black")
-    plt.title("Distribución de Edades")
-    plt.xlabel("Edad"); plt.ylabel("Frecuencia")
-    plt.tight_layout(); plt.savefig(fig1, dpi=120); plt.close()
+    total_cols = ctx.total_cols
+    with _etapa("estadisticas_demografia", filas=total_reg):
+        # una pasada por acumulador; cada uno se podría calcular por bloques y unir
+        edad = df[edad_col].to_numpy(dtype="float64", na_value=np.nan)
+        mom = Momentos.desde(edad)
+        edad_prom, edad_min, edad_max = mom.media, mom.minimo, mom.maximo
+        hist_edad = Histograma.desde(edad)
+
+        por_rango = hist_edad.por_intervalos(AGE_BINS)[0]
+        rango_mas_comun = AGE_LABELS[int(np.argmax(por_rango))] if por_rango.sum() else None
+
+        genero_counts = None
+        if genero_col:
+            genero_counts = ctx.norm("genero").value_counts(dropna=False)
+
+        grado_mas_frec = None
+        if grado_col:
+            grado_mas_frec = Conteo.desde(ctx.norm("grado", upper=False)).moda()
+
+    # Figuras (solo se redibujan si cambiaron las columnas de las que dependen)
+    renders = []
+    fig1 = _fig_path("demografia_hist_edades.png")
+    if fig1 and _render_needed(fig1, ctx.hash_cols(edad_col)):
+        counts, edges = hist_edad.histograma(bins=20)
+        renders.append((_fig_hist, dict(
+            path=fig1, counts=counts, edges=edges,
+            title="Distribución de Edades", xlabel="Edad", ylabel="Frecuencia")))
 
     fig2 = None
     if genero_col:
-        fig2 = FIG_DIR / "demografia_edad_prom_por_genero.png"
-        plt.figure(figsize=(9,5))
-        (df[[edad_col, genero_col]].dropna().groupby(genero_col)[edad_col]
-         .mean().sort_values(ascending=False)
-         .plot(kind="bar", edgecolor="black"))
-        plt.title("Edad promedio por género")
-        plt.xlabel("Género"); plt.ylabel("Edad promedio")
-        plt.tight_layout(); plt.savefig(fig2, dpi=120); plt.close()
+        fig2 = _fig_path("demografia_edad_prom_por_genero.png")
+        if fig2 and _render_needed(fig2, ctx.hash_cols(edad_col, genero_col)):
+            prom = (df[[edad_col, genero_col]].dropna().groupby(genero_col, observed=True)[edad_col]
+                    .mean().sort_values(ascending=False))
+            renders.append((_fig_bar, dict(
+                path=fig2, labels=list(prom.index), values=prom.to_numpy(),
+                title="Edad promedio por género", xlabel="Género", ylabel="Edad promedio",
+                figsize=(9,5), rotation=90)))
 
     fig3 = None
     if grado_col:
-        fig3 = FIG_DIR / "demografia_top_grados.png"
-        plt.figure(figsize=(10,5))
-        (df[grado_col].astype(str).str.strip().replace({"nan": pd.NA}).dropna()
-         .value_counts().head(15)
-         .plot(kind="bar", edgecolor="black"))
-        plt.title("Top 15 grados/rangos")
-        plt.xlabel("Grado/Rango"); plt.ylabel("Cantidad")
-        plt.xticks(rotation=45, ha="right")
-        plt.tight_layout(); plt.savefig(fig3, dpi=120); plt.close()
+        fig3 = _fig_path("demografia_top_grados.png")
+        if fig3 and _render_needed(fig3, ctx.hash_cols(grado_col)):
+            top = ctx.norm("grado", upper=False).value_counts().head(15)
+            renders.append((_fig_bar, dict(
+                path=fig3, labels=list(top.index), values=top.to_numpy(),
+                title="Top 15 grados/rangos", xlabel="Grado/Rango", ylabel="Cantidad")))
+
+    _render_figs(renders)
 
     # Reporte
     if save_md:
@@ -253,7 +1789,8 @@ def run_demografia(save_md: bool = True) -> dict:
         md = [
             "# Demografía básica",
             f"_Actualizado: {dt.datetime.now():%Y-%m-%d %H:%M}_",
-            f"_Fuente de datos: `{data_path.relative_to(PROJECT_DIR).as_posix()}`_",
+            f"_Fuente de datos: `{_rel(data_path)}`_",
+            *([f"_Segmento: {_codigo_md(ctx.filtro)}_"] if ctx.filtro else []),
             "",
             "## Resumen general",
             f"- Total de registros: **{total_reg}**",
@@ -274,46 +1811,170 @@ def run_demografia(save_md: bool = True) -> dict:
              "No se encontró columna de grado/rango o no hay modo definido."),
             "",
             "## Visualizaciones",
-            f"![Histograma de edades](figs/{fig1.name})",
+            (f"![Histograma de edades](figs/{fig1.name})" if fig1 else _SIN_FIGURAS),
             (f"\n\n![Edad promedio por género](figs/{fig2.name})" if fig2 else ""),
             (f"\n\n![Top grados](figs/{fig3.name})" if fig3 else "")
         ]
-        md_path.write_text("\n".join(md), encoding="utf-8")
+        _write_md(md_path, "\n".join(md))
+    _manifest().save()
 
     return {
         "rango_mas_comun": str(rango_mas_comun) if rango_mas_comun else None,
         "genero_counts": genero_counts,
         "grado_mas_frec": grado_mas_frec,
-        "figs": [str(fig1)] + ([str(fig2)] if fig2 else []) + ([str(fig3)] if fig3 else [])
+        "figs": [str(f) for f in (fig1, fig2, fig3) if f]
     }
 
+# ---------------------------------------------------------------------
+# Motor de agregación por estado civil (una pasada sobre códigos enteros)
+# ---------------------------------------------------------------------
+@dataclass
+class AgregadoFamiliar:
+    """Agregados por estado civil que usan tanto las tablas como las figuras.
+
+    Todo se calcula con np.bincount sobre los códigos de la categoría; las
+    medianas salen del histograma exacto de edades por estado civil. Son
+    conteos y sumas, así que dos agregados (p. ej. de dos bloques o dos
+    archivos) se combinan con unir().
+    """
+    ec: list                       # etiquetas de estado civil (orden de las categorías)
+    n: np.ndarray                  # registros por estado civil
+    edad_hist: Histograma = None   # edades por estado civil (una fila por grupo)
+    generos: list = None
+    ec_genero: np.ndarray = None   # conteos estado civil x género
+    con_hijos: np.ndarray = None
+    hijos_n: np.ndarray = None     # registros con número de hijos conocido
+    hijos_sum: np.ndarray = None
+    conv_con_hijos: np.ndarray = None
+
+    def _frame(self, data: dict, mask=None) -> pd.DataFrame:
+        out = pd.DataFrame(data, index=pd.Index(self.ec, name="Estado civil"))
+        return out if mask is None else out[mask]
+
+    def conteo_ec(self) -> pd.Series:
+        return pd.Series(self.n, index=self.ec).sort_values(ascending=False, kind="stable")
+
+    def edad_por_ec(self) -> pd.DataFrame:
+        k = self.edad_hist.n
+        ok = k > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.edad_hist.suma() / k
+        return (self._frame({"count": k, "mean": mean, "median": self.edad_hist.cuantil(0.5)}, ok)
+                .sort_values("mean", ascending=False))
+
+    def edad_cajas(self) -> list:
+        """Estadísticos de caja de la edad por estado civil con al menos un dato."""
+        return [self.edad_hist.caja(i, label=self.ec[i]) for i, k in enumerate(self.edad_hist.n) if k]
+
+    def ec_x_genero_pct(self) -> pd.DataFrame:
+        tot = self.ec_genero.sum(axis=1)
+        rows, cols = tot > 0, self.ec_genero.sum(axis=0) > 0
+        pct = self.ec_genero[rows][:, cols] / tot[rows, None] * 100
+        return pd.DataFrame(pct, index=pd.Index(np.asarray(self.ec, dtype=object)[rows], name="Estado civil"),
+                            columns=np.asarray(self.generos, dtype=object)[cols]).round(2)
+
+    def hijos_por_ec(self) -> pd.DataFrame:
+        ok = self.n > 0
+        data = {"pct_con_hijos": np.round(100 * self.con_hijos / np.where(ok, self.n, 1), 2)}
+        if self.hijos_n is not None:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                data["promedio_hijos"] = np.round(self.hijos_sum / self.hijos_n, 2)
+        return self._frame(data, ok)
+
+    def conv_por_ec(self) -> pd.Series:
+        ok = self.con_hijos > 0
+        pct = np.round(100 * self.conv_con_hijos / np.where(ok, self.con_hijos, 1), 2)
+        return self._frame({"Pct convive con familia (entre quienes tienen hijos)": pct}, ok).iloc[:, 0]
+
+    def unir(self, otro: "AgregadoFamiliar") -> "AgregadoFamiliar":
+        """Suma de dos agregados; estados civiles y géneros se alinean por etiqueta."""
+        ec = sorted(set(self.ec) | set(otro.ec))
+        out = AgregadoFamiliar(ec=ec, n=_alinear(self.n, self.ec, ec) + _alinear(otro.n, otro.ec, ec))
+        if self.edad_hist is not None:
+            a, b = (Histograma(agg.edad_hist.valores, _alinear(agg.edad_hist.conteos, agg.ec, ec))
+                    for agg in (self, otro))
+            out.edad_hist = a.unir(b)
+        if self.ec_genero is not None:
+            out.generos = sorted(set(self.generos) | set(otro.generos))
+            out.ec_genero = sum(
+                _alinear(_alinear(agg.ec_genero, agg.ec, ec), agg.generos, out.generos, axis=1)
+                for agg in (self, otro))
+        for campo in ("con_hijos", "hijos_n", "hijos_sum", "conv_con_hijos"):
+            if getattr(self, campo) is not None:
+                setattr(out, campo, sum(_alinear(getattr(agg, campo), agg.ec, ec) for agg in (self, otro)))
+        return out
+
+def _alinear(arr: np.ndarray, desde: list, hacia: list, axis: int = 0) -> np.ndarray:
+    """Reordena el eje 'axis' de las etiquetas 'desde' a 'hacia' (ceros donde falten)."""
+    shape = list(arr.shape)
+    shape[axis] = len(hacia)
+    out = np.zeros(shape, dtype=arr.dtype)
+    pos = {x: i for i, x in enumerate(hacia)}
+    np.moveaxis(out, axis, 0)[[pos[x] for x in desde]] = np.moveaxis(arr, axis, 0)
+    return out
+
+@_perfilado("agregar_familiar")
+def _agregar_familiar(ec: pd.Series, edad=None, genero=None, tiene_hijos=None,
+                      hijos_num=None, convive=None) -> AgregadoFamiliar:
+    """Agrega por estado civil ('ec' categórico) todas las métricas del paso 3."""
+    codes = ec.cat.codes.to_numpy()
+    k = len(ec.cat.categories)
+    valid = codes >= 0
+    c = codes[valid]
+    agg = AgregadoFamiliar(ec=[str(x) for x in ec.cat.categories],
+                           n=np.bincount(c, minlength=k))
+
+    if edad is not None:
+        agg.edad_hist = Histograma.desde(edad.to_numpy(dtype="float64", na_value=np.nan)[valid], c, k)
+
+    if genero is not None:
+        g = genero.cat.codes.to_numpy()[valid]
+        ng = len(genero.cat.categories)
+        both = g >= 0
+        agg.generos = [str(x) for x in genero.cat.categories]
+        agg.ec_genero = np.bincount(c[both] * ng + g[both], minlength=k * ng).reshape(k, ng)
+
+    if tiene_hijos is not None:
+        th = tiene_hijos.to_numpy(dtype=bool)[valid]
+        agg.con_hijos = np.bincount(c, weights=th, minlength=k).astype(np.int64)
+        if hijos_num is not None:
+            h = hijos_num.to_numpy(dtype="float64", na_value=np.nan)[valid]
+            known = ~np.isnan(h)
+            agg.hijos_n = np.bincount(c[known], minlength=k)
+            agg.hijos_sum = np.bincount(c[known], weights=h[known], minlength=k)
+        if convive is not None:
+            cv = convive.to_numpy(dtype=bool)[valid]
+            agg.conv_con_hijos = np.bincount(c, weights=th & cv, minlength=k).astype(np.int64)
+    return agg
+
 # ---------------------------------------------------------------------
 # PASO 3: FAMILIAR (usa dataset limpio si existe) + NUEVA SECCIÓN
 # ---------------------------------------------------------------------
-def run_familiar(save_md: bool = True) -> dict:
+# Estados civiles (ya normalizados) que cuentan como casado
+CASADO_VALUES = {"CASADO", "CASADOS", "CASADA", "MATRIMONIO", "CASAD@"}
+
+@_perfilado("familiar")
+def run_familiar(save_md: bool = True, ctx: Contexto = None) -> dict:
     _ensure_dirs()
-    data_path = _prefer_clean_path()
-    df = pd.read_excel(data_path)
+    ctx = ctx or _contexto_limpio()
+    df, data_path = ctx.df, ctx.data_path
 
-    edad_col   = _find_col(df, ["EDAD2", "EDAD", "Edad"])
-    ec_col     = _find_col(df, ["ESTADO_CIVIL", "Estado civil", "ESTADOCIVIL"])
-    hijos_col  = _find_col(df, ["HIJOS", "NUM_HIJOS", "N_HIJOS", "# HIJOS", "TIENE_HIJOS"])
-    conv_col   = _find_col(df, ["HABITA_VIVIENDA_FAMILIAR", "VIVE_CON_FAMILIA", "VIVE_CON_HIJOS", "CONVIVE_FAMILIA"])
-    genero_col = _find_col(df, ["GENERO", "GÉNERO", "SEXO", "Sexo", "Genero"])
+    edad_col   = ctx.cols["edad"]
+    ec_col     = ctx.cols["ec"]
+    hijos_col  = ctx.cols["hijos"]
+    conv_col   = ctx.cols["conv"]
+    genero_col = ctx.cols["genero"]
 
     if ec_col is None:
         raise ValueError("No se encontró columna de estado civil (ESTADO_CIVIL).")
 
-    df = df.copy()
-    if edad_col:
-        df[edad_col] = pd.to_numeric(df[edad_col], errors="coerce")
-
     # % casados
-    ec_norm = _normalize_text_series(df[ec_col])
-    es_casado = ec_norm.isin({"CASADO", "CASADOS", "CASADA", "MATRIMONIO", "CASAD@"})
+    ec_norm = ctx.norm("ec")
+    es_casado = ec_norm.isin(CASADO_VALUES)
     pct_casados = round(100 * es_casado.mean(), 2)
 
     # hijos (boolean y numérico si aplica)
+    no_clasificados = {}   # respuestas sí/no que no se reconocieron, por rol
     tiene_hijos = None
     total_tiene_hijos = None
     hijos_num = None
@@ -323,99 +1984,85 @@ def run_familiar(save_md: bool = True) -> dict:
             tiene_hijos = hijos_num.fillna(0) > 0
         else:
             hijos_num = None
-            tiene_hijos = df[hijos_col].map(_is_yes)
-        tiene_hijos = tiene_hijos.fillna(False)
+            tiene_hijos, no_clasificados["hijos"] = ctx.si_no("hijos")
+        tiene_hijos = tiene_hijos.fillna(False).astype(bool)
         total_tiene_hijos = int(tiene_hijos.sum())
 
     # convivencia
     total_conviven = None
     conviven_bool = None
     if conv_col:
-        conviven_bool = df[conv_col].map(_is_yes).fillna(False)
+        conviven_bool, no_clasificados["conv"] = ctx.si_no("conv")
+        conviven_bool = conviven_bool.fillna(False).astype(bool)
         total_conviven = int(conviven_bool.sum())
 
+    # ---- Todas las métricas por estado civil en una sola agregación
+    agg = _agregar_familiar(
+        ec_norm,
+        edad=df[edad_col] if edad_col else None,
+        genero=ctx.norm("genero") if genero_col else None,
+        tiene_hijos=tiene_hijos, hijos_num=hijos_num, convive=conviven_bool)
+
     # ---- Relación edad–estado civil (boxplot + resumen)
+    renders = []
     fig_box = None
     edad_por_ec = None
     if edad_col:
-        edad_por_ec = (df[[edad_col, ec_col]].dropna()
-                       .groupby(ec_col)[edad_col]
-                       .agg(["count", "mean", "median"])
-                       .sort_values("mean", ascending=False))
-        plt.figure(figsize=(10,6))
-        df[[edad_col, ec_col]].dropna().boxplot(by=ec_col, column=edad_col, grid=False)
-        plt.suptitle("")
-        plt.title("Distribución de edad por estado civil")
-        plt.xlabel("Estado civil"); plt.ylabel("Edad")
-        plt.xticks(rotation=45, ha="right")
-        fig_box = FIG_DIR / "familiar_box_edad_por_estado_civil.png"
-        plt.tight_layout(); plt.savefig(fig_box, dpi=120); plt.close()
+        edad_por_ec = agg.edad_por_ec()
+        fig_box = _fig_path("familiar_box_edad_por_estado_civil.png")
+        if fig_box and _render_needed(fig_box, ctx.hash_cols(edad_col, ec_col)):
+            renders.append((_fig_box, dict(
+                path=fig_box, stats=agg.edad_cajas(),
+                title="Distribución de edad por estado civil", xlabel="Estado civil", ylabel="Edad")))
 
     # ---- Distribución estado civil
-    fig_ec = FIG_DIR / "familiar_estado_civil.png"
-    plt.figure(figsize=(10,5))
-    df[ec_col].astype(str).str.strip().value_counts().plot(kind="bar", edgecolor="black")
-    plt.title("Distribución del Estado Civil")
-    plt.xlabel("Estado Civil"); plt.ylabel("Cantidad")
-    plt.xticks(rotation=45, ha="right")
-    plt.tight_layout(); plt.savefig(fig_ec, dpi=120); plt.close()
+    fig_ec = _fig_path("familiar_estado_civil.png")
+    if fig_ec and _render_needed(fig_ec, ctx.hash_cols(ec_col)):
+        vc = agg.conteo_ec()
+        renders.append((_fig_bar, dict(
+            path=fig_ec, labels=list(vc.index), values=vc.to_numpy(),
+            title="Distribución del Estado Civil", xlabel="Estado Civil", ylabel="Cantidad")))
 
     # =================== NUEVA SECCIÓN ===================
     # 1) Cruce Estado civil x Género (porcentajes por estado civil)
     ec_x_genero_md = None
     fig_ec_genero = None
     if genero_col:
-        gen_norm = _normalize_text_series(df[genero_col]).replace({"NAN": np.nan})
-        ctab = pd.crosstab(ec_norm, gen_norm, normalize="index") * 100
-        ctab = ctab.round(2)
-        ec_x_genero_md = _df_to_md(ctab.reset_index().rename(columns={ec_col: "Estado civil"}), index=False)
+        ctab = agg.ec_x_genero_pct()
+        ec_x_genero_md = _df_to_md(ctab.reset_index(), index=False)
 
         # barra apilada
-        fig_ec_genero = FIG_DIR / "familiar_estado_civil_por_genero_pct.png"
-        plt.figure(figsize=(11,6))
-        # replot stacked percentages
-        bottom = np.zeros(len(ctab))
-        for col in ctab.columns:
-            plt.bar(ctab.index.astype(str), ctab[col].values, bottom=bottom, edgecolor="black", label=str(col))
-            bottom += ctab[col].values
-        plt.title("Estado civil por género (%)")
-        plt.xlabel("Estado civil"); plt.ylabel("Porcentaje")
-        plt.xticks(rotation=45, ha="right")
-        plt.legend(title="Género", bbox_to_anchor=(1.02, 1), loc="upper left")
-        plt.tight_layout(); plt.savefig(fig_ec_genero, dpi=120); plt.close()
+        fig_ec_genero = _fig_path("familiar_estado_civil_por_genero_pct.png")
+        if fig_ec_genero and _render_needed(fig_ec_genero, ctx.hash_cols(ec_col, genero_col)):
+            renders.append((_fig_stacked, dict(
+                path=fig_ec_genero, index=list(ctab.index), columns=list(ctab.columns),
+                values=ctab.to_numpy(), title="Estado civil por género (%)",
+                xlabel="Estado civil", ylabel="Porcentaje", legend_title="Género")))
 
     # 2) Hijos por estado civil: % con hijos y promedio de # hijos
     hijos_ec_md = None
     fig_mean_hijos = None
     if tiene_hijos is not None:
-        tmp = pd.DataFrame({ec_col: ec_norm, "tiene_hijos": tiene_hijos})
-        if hijos_num is not None:
-            tmp["n_hijos"] = hijos_num
-        agg = tmp.groupby(ec_col).agg(pct_con_hijos=("tiene_hijos", lambda s: round(100*s.mean(), 2)))
-        if hijos_num is not None:
-            agg["promedio_hijos"] = tmp.groupby(ec_col)["n_hijos"].mean().round(2)
-        hijos_ec_md = _df_to_md(agg.reset_index().rename(columns={ec_col: "Estado civil"}), index=False)
+        hijos_tab = agg.hijos_por_ec()
+        hijos_ec_md = _df_to_md(hijos_tab.reset_index(), index=False)
 
         if hijos_num is not None:
-            fig_mean_hijos = FIG_DIR / "familiar_promedio_hijos_por_estado_civil.png"
-            plt.figure(figsize=(10,5))
-            tmp.groupby(ec_col)["n_hijos"].mean().sort_values(ascending=False).plot(kind="bar", edgecolor="black")
-            plt.title("Promedio de número de hijos por estado civil")
-            plt.xlabel("Estado civil"); plt.ylabel("Promedio de hijos")
-            plt.xticks(rotation=45, ha="right")
-            plt.tight_layout(); plt.savefig(fig_mean_hijos, dpi=120); plt.close()
+            fig_mean_hijos = _fig_path("familiar_promedio_hijos_por_estado_civil.png")
+            if fig_mean_hijos and _render_needed(fig_mean_hijos, ctx.hash_cols(ec_col, hijos_col)):
+                prom = hijos_tab["promedio_hijos"].sort_values(ascending=False)
+                renders.append((_fig_bar, dict(
+                    path=fig_mean_hijos, labels=list(prom.index), values=prom.to_numpy(),
+                    title="Promedio de número de hijos por estado civil",
+                    xlabel="Estado civil", ylabel="Promedio de hijos")))
 
     # 3) Convivencia entre quienes tienen hijos (por estado civil)
     conv_ec_md = None
     if (conviven_bool is not None) and (tiene_hijos is not None):
-        tmp2 = pd.DataFrame({ec_col: ec_norm, "tiene_hijos": tiene_hijos, "convive": conviven_bool})
-        # considerar sólo quienes tienen hijos
-        sub = tmp2[tmp2["tiene_hijos"]]
-        if not sub.empty:
-            conv_tab = sub.groupby(ec_col)["convive"].mean().mul(100).round(2)
-            conv_ec_md = _df_to_md(conv_tab.rename("Pct convive con familia (entre quienes tienen hijos)")
-                                   .reset_index().rename(columns={ec_col: "Estado civil"}), index=False)
+        conv_tab = agg.conv_por_ec()
+        if not conv_tab.empty:
+            conv_ec_md = _df_to_md(conv_tab.reset_index(), index=False)
     # ================= FIN NUEVA SECCIÓN =================
+    _render_figs(renders)
 
     # Reporte
     if save_md:
@@ -423,7 +2070,8 @@ def run_familiar(save_md: bool = True) -> dict:
         md = [
             "# Análisis familiar",
             f"_Actualizado: {dt.datetime.now():%Y-%m-%d %H:%M}_",
-            f"_Fuente de datos: `{data_path.relative_to(PROJECT_DIR).as_posix()}`_",
+            f"_Fuente de datos: `{_rel(data_path)}`_",
+            *([f"_Segmento: {_codigo_md(ctx.filtro)}_"] if ctx.filtro else []),
             "",
             "## Preguntas y respuestas",
             f"1. **¿Qué porcentaje del personal está casado?**  \n**{pct_casados}%**",
@@ -433,6 +2081,8 @@ def run_familiar(save_md: bool = True) -> dict:
              else "- No se encontró columna para hijos."),
             ("- Viven con familia/hijos: **{}**".format(total_conviven) if total_conviven is not None
              else "- No se encontró columna de convivencia."),
+            *[f"- Respuestas no reconocidas como sí/no en `{ctx.cols[rol]}`: **{n}** (se cuentan como \"no\")."
+              for rol, n in no_clasificados.items() if n],
             "",
             "3. **¿Hay relación entre edad y estado civil?**",
             "Sí. Los resultados muestran que los **solteros presentan edades más bajas**, "
@@ -442,11 +2092,11 @@ def run_familiar(save_md: bool = True) -> dict:
             "de soltero a casado, separado o viudo.",
             "",
             "## Visualizaciones",
-            f"![Estado civil](figs/{fig_ec.name})",
+            (f"![Estado civil](figs/{fig_ec.name})" if fig_ec else _SIN_FIGURAS),
             (f"\n\n![Boxplot edad por estado civil](figs/{fig_box.name})" if fig_box else ""),
             "",
             "## Resumen tabular",
-            (_df_to_md(edad_por_ec) if isinstance(edad_por_ec, pd.DataFrame) else ""),
+            (_df_to_md(edad_por_ec.reset_index()) if isinstance(edad_por_ec, pd.DataFrame) else ""),
             "",
             "## Nueva sección: Cruces y métricas familiares",
             "- Esta sección agrega cruces entre **estado civil y género**, así como **indicadores de hijos**.",
@@ -462,23 +2112,537 @@ def run_familiar(save_md: bool = True) -> dict:
             "### Convivencia (entre quienes tienen hijos)",
             (conv_ec_md if conv_ec_md is not None else "_No se pudo calcular (faltan columnas de hijos/convivencia)._"),
         ]
-        md_path.write_text("\n".join(md), encoding="utf-8")
+        _write_md(md_path, "\n".join(md))
+    _manifest().save()
 
     return {
         "pct_casados": pct_casados,
         "total_tiene_hijos": total_tiene_hijos,
         "total_conviven": total_conviven,
-        "figs": [str(fig_ec)] + ([str(fig_box)] if fig_box else []),
+        "no_clasificados": no_clasificados,
+        "agregado": agg,
+        "figs": [str(f) for f in (fig_ec, fig_box) if f],
+    }
+
+# ---------------------------------------------------------------------
+# Cubo pre-agregado: cortes demográficos sin volver a los registros
+# ---------------------------------------------------------------------
+CUBE_MEASURES = ("n", "edad_n", "edad_sum", "edad_sumsq", "hijos_n", "hijos_sum", "hijos_sumsq")
+
+def _cube_path() -> Path:
+    return REPORT_DIR / ("cubo_demografico.parquet" if _has_pyarrow() else "cubo_demografico.pkl")
+
+class Cubo:
+    """Conteos, sumas y sumas de cuadrados por combinación observada de dimensiones.
+
+    Cualquier agregación (medias, desviaciones, porcentajes, cruces) sobre un
+    subconjunto de dimensiones se obtiene sumando filas del cubo.
+    """
+
+    def __init__(self, data: pd.DataFrame, dims: list):
+        self.data = data
+        self.dims = list(dims)
+
+    def guardar(self, path: Path = None) -> Path:
+        path = path or _cube_path()
+        if path.suffix == ".parquet":
+            self.data.to_parquet(path, index=False)
+        else:
+            self.data.to_pickle(path)
+        return path
+
+    @classmethod
+    def cargar(cls, path: Path = None) -> "Cubo":
+        path = path or _cube_path()
+        data = pd.read_parquet(path) if path.suffix == ".parquet" else pd.read_pickle(path)
+        return cls(data, [c for c in data.columns if c not in CUBE_MEASURES])
+
+    def _check_dims(self, dims) -> None:
+        unknown = [d for d in dims if d not in self.dims]
+        if unknown:
+            raise ValueError(f"Dimensiones desconocidas: {', '.join(unknown)} "
+                             f"(disponibles: {', '.join(self.dims)})")
+
+    def _filtrar(self, filtros: dict = None) -> pd.DataFrame:
+        self._check_dims(filtros or {})
+        data = self.data
+        for dim, val in (filtros or {}).items():
+            vals = val if isinstance(val, (list, tuple, set)) else [val]
+            data = data[data[dim].isin(vals)]
+        return data
+
+    def consultar(self, por=(), filtros: dict = None) -> pd.DataFrame:
+        """Roll-up por las dimensiones 'por' (opcionalmente filtrado).
+
+        Devuelve n, % del total filtrado, edad media/desviación y promedio de hijos.
+        """
+        data = self._filtrar(filtros)
+        por = list(por)
+        self._check_dims(por)
+        if por:
+            sums = data.groupby(por, observed=True, dropna=False)[list(CUBE_MEASURES)].sum()
+        else:
+            sums = data[list(CUBE_MEASURES)].sum().to_frame("Total").T
+        n_tot = sums["n"].sum()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = (sums["edad_sumsq"] - sums["edad_sum"] ** 2 / sums["edad_n"]) / (sums["edad_n"] - 1)
+            out = pd.DataFrame({
+                "n": sums["n"].astype("int64"),
+                "pct": (100 * sums["n"] / n_tot).round(2),
+                "edad_media": (sums["edad_sum"] / sums["edad_n"]).round(2),
+                "edad_std": np.sqrt(var.clip(lower=0)).round(2),
+                "hijos_media": (sums["hijos_sum"] / sums["hijos_n"]).round(2),
+            })
+        return out
+
+    def crosstab(self, fila: str, columna: str, filtros: dict = None, normalize: str = "index") -> pd.DataFrame:
+        """Cruce de conteos fila x columna; normalize='index'/'columns' da porcentajes."""
+        data = self._filtrar(filtros)
+        self._check_dims([fila, columna])
+        tab = (data.groupby([fila, columna], observed=True, dropna=False)["n"].sum()
+               .unstack(columna, fill_value=0))
+        if normalize == "index":
+            tab = tab.div(tab.sum(axis=1), axis=0).mul(100).round(2)
+        elif normalize == "columns":
+            tab = tab.div(tab.sum(axis=0), axis=1).mul(100).round(2)
+        return tab
+
+@_perfilado("cubo")
+def build_cubo(ctx: Contexto = None, save: bool = True) -> Cubo:
+    """Construye el cubo desde el dataset limpio.
+
+    Dimensiones: rango de edad (_age_bins) y cada rol categórico o sí/no del
+    esquema presente en los datos (género, grado, estado civil, hijos,
+    convivencia y los que se agreguen, p. ej. unidad o año).
+    """
+    _ensure_dirs()
+    ctx = ctx or _contexto_limpio()
+    df, cols = ctx.df, ctx.cols
+    schema = _load_schema()
+
+    dims = {}
+    edad = None
+    if cols.get("edad"):
+        edad = df[cols["edad"]].astype("float64")
+        dims["rango_edad"] = _age_bins(edad)
+    hijos_num = None
+    for role, spec in schema.items():
+        col = cols.get(role)
+        if not col or role == "edad":
+            continue
+        if role == "hijos" and pd.api.types.is_numeric_dtype(df[col]):
+            hijos_num = df[col].astype("float64")
+            dims[role] = (hijos_num > 0).astype("boolean").mask(hijos_num.isna())
+        elif spec.get("tipo") == "si_no":
+            dims[role] = ctx.si_no(role)[0]
+        elif spec.get("tipo") == "categorico":
+            dims[role] = ctx.norm(role)
+
+    frame = pd.DataFrame(dims)
+    frame["n"] = 1
+    e = edad if edad is not None else pd.Series(np.nan, index=df.index)
+    frame["edad_n"] = e.notna().astype("int64")
+    frame["edad_sum"] = e.fillna(0)
+    frame["edad_sumsq"] = e.fillna(0) ** 2
+    h = hijos_num if hijos_num is not None else pd.Series(np.nan, index=df.index)
+    frame["hijos_n"] = h.notna().astype("int64")
+    frame["hijos_sum"] = h.fillna(0)
+    frame["hijos_sumsq"] = h.fillna(0) ** 2
+
+    with _etapa("agrupar_cubo", filas=len(frame)):
+        data = (frame.groupby(list(dims), observed=True, dropna=False)[list(CUBE_MEASURES)].sum()
+                .reset_index())
+    cubo = Cubo(data, list(dims))
+    if save:
+        with _etapa(f"escribir:{_cube_path().name}", filas=len(data)):
+            cubo.guardar()
+    return cubo
+
+# ---------------------------------------------------------------------
+# Segmentos: reportes por subconjunto (base, grado, rango de edad, ...)
+# desde un solo Contexto, con filtros tipo "GENERO == 'FEMENINO' & EDAD2 >= 35"
+# ---------------------------------------------------------------------
+# Como en DataFrame.query, &, | y ~ tienen menos precedencia que las comparaciones
+_BOOLEANOS = {"&": "and", "|": "or", "~": "not"}
+_COMPARADORES = {ast.Eq: "==", ast.NotEq: "!=", ast.Lt: "<", ast.LtE: "<=",
+                 ast.Gt: ">", ast.GtE: ">=", ast.In: "in", ast.NotIn: "not in"}
+_INVERSO = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "==": "==", "!=": "!="}
+
+class FiltroInvalido(ValueError):
+    """Filtro de segmento mal escrito o que no encaja con los datos (columna, tipo, operador)."""
+
+def _parse_filtro(expr: str) -> tuple:
+    """(árbol ast, {marcador: columna}) de un filtro; `columna con espacios` va entre comillas invertidas."""
+    columnas = {}
+    def _marcar(m):
+        marcador = f"__col{len(columnas)}__"
+        columnas[marcador] = m.group(1)
+        return marcador
+    texto = re.sub(r"`([^`]+)`", _marcar, expr)
+    try:
+        tokens = [(tokenize.NAME, _BOOLEANOS[t.string]) if t.type == tokenize.OP and t.string in _BOOLEANOS
+                  else (t.type, t.string)
+                  for t in tokenize.generate_tokens(io.StringIO(texto).readline)]
+        return ast.parse(tokenize.untokenize(tokens), mode="eval").body, columnas
+    except (tokenize.TokenError, SyntaxError) as e:
+        raise FiltroInvalido(f"Filtro inválido: {expr} ({e})") from None
+
+class IndiceSegmentos:
+    """Evalúa filtros sobre un Contexto con máscaras de bits precalculadas.
+
+    Cada columna categórica se indexa una vez (un bitmap empaquetado por valor,
+    1 bit por fila); cada comparación numérica se guarda como máscara. Un filtro
+    se resuelve combinando bitmaps con and/or/not, sin tocar el DataFrame.
+    Nombres válidos: columnas del dataset limpio, roles del esquema y 'rango_edad'.
+    Los valores de texto se comparan normalizados (sin espacios y en mayúsculas).
+    """
+
+    def __init__(self, ctx: Contexto):
+        self.ctx = ctx
+        self.n = len(ctx.df)
+        self._columnas = {}    # nombre -> serie categórica o array float64
+        self._bitmaps = {}     # nombre -> un bitmap por categoría
+        self._mascaras = {}    # (nombre, op, valor) -> bitmap
+
+    def _columna(self, nombre: str):
+        if nombre not in self._columnas:
+            ctx = self.ctx
+            roles = {c: r for r, c in ctx.cols.items() if c}
+            if nombre == "rango_edad" and ctx.cols.get("edad"):
+                s = _age_bins(ctx.df[ctx.cols["edad"]].astype("float64"))
+            else:
+                col = ctx.cols.get(nombre) or nombre
+                if col not in ctx.df.columns:
+                    raise FiltroInvalido(f"Columna o rol desconocido en el filtro: {nombre}")
+                s = ctx.df[col]
+                if pd.api.types.is_numeric_dtype(s) or pd.api.types.is_bool_dtype(s):
+                    s = s.to_numpy(dtype="float64", na_value=np.nan)
+                elif col in roles:
+                    s = ctx.norm(roles[col])
+                else:
+                    s = _normalize_text_series(s)
+            self._columnas[nombre] = s
+        return self._columnas[nombre]
+
+    def bitmaps(self, nombre: str) -> dict:
+        """{valor: bitmap} de una columna categórica (se construye una sola vez)."""
+        if nombre not in self._bitmaps:
+            s = self._columna(nombre)
+            if isinstance(s, np.ndarray):
+                raise FiltroInvalido(f"'{nombre}' es numérica: use comparaciones (<, >=, ...), no valores")
+            codes = s.cat.codes.to_numpy()
+            self._bitmaps[nombre] = {cat: np.packbits(codes == k) for k, cat in enumerate(s.cat.categories)}
+        return self._bitmaps[nombre]
+
+    def _vacio(self) -> np.ndarray:
+        return np.zeros((self.n + 7) // 8, dtype=np.uint8)
+
+    def _comparar(self, nombre: str, op: str, valor) -> np.ndarray:
+        key = (nombre, op, repr(valor))
+        if key in self._mascaras:
+            return self._mascaras[key]
+        s = self._columna(nombre)
+        valores = list(valor) if op in ("in", "not in") else [valor]
+        if isinstance(s, np.ndarray):
+            if any(isinstance(v, str) for v in valores):
+                raise FiltroInvalido(f"'{nombre}' es numérica: compárela con números, no con texto")
+            if op in ("in", "not in", "==", "!="):
+                b = np.packbits(np.isin(s, np.asarray(valores, dtype="float64")))
+            else:
+                b = np.packbits({"<": np.less, "<=": np.less_equal, ">": np.greater,
+                                 ">=": np.greater_equal}[op](s, float(valor)))
+        else:
+            if op not in ("in", "not in", "==", "!="):
+                raise FiltroInvalido(f"'{nombre}' es categórica: solo admite ==, !=, in y not in")
+            bm = self.bitmaps(nombre)
+            b = self._vacio()
+            for v in valores:
+                b = b | bm.get(str(v).strip().upper(), bm.get(v, 0))
+        if op in ("!=", "not in"):
+            b = ~b
+        self._mascaras[key] = b
+        return b
+
+    def _evaluar(self, nodo, columnas: dict) -> np.ndarray:
+        if isinstance(nodo, ast.BoolOp):
+            partes = [self._evaluar(v, columnas) for v in nodo.values]
+            comb = np.bitwise_and if isinstance(nodo.op, ast.And) else np.bitwise_or
+            return comb.reduce(partes)
+        if isinstance(nodo, ast.UnaryOp) and isinstance(nodo.op, ast.Not):
+            return ~self._evaluar(nodo.operand, columnas)
+        if isinstance(nodo, ast.Compare):
+            b, izq = None, nodo.left
+            for op, der in zip(nodo.ops, nodo.comparators):   # 30 <= EDAD2 < 40
+                parte = self._comparacion(izq, _COMPARADORES.get(type(op)), der, columnas)
+                b = parte if b is None else b & parte
+                izq = der
+            return b
+        raise FiltroInvalido(f"Expresión no soportada en el filtro: {ast.unparse(nodo)}")
+
+    def _comparacion(self, izq, op: str, der, columnas: dict) -> np.ndarray:
+        if isinstance(der, ast.Name) and not isinstance(izq, ast.Name) and op in _INVERSO:
+            izq, der, op = der, izq, _INVERSO[op]      # 35 <= EDAD2  ->  EDAD2 >= 35
+        if op is None or not isinstance(izq, ast.Name) or isinstance(der, ast.Name):
+            raise FiltroInvalido(f"Cada comparación debe ser columna contra valor: {ast.unparse(izq)} ... {ast.unparse(der)}")
+        try:
+            valor = ast.literal_eval(der)
+        except ValueError:
+            raise FiltroInvalido(f"Valor no válido en el filtro: {ast.unparse(der)}") from None
+        return self._comparar(columnas.get(izq.id, izq.id), op, valor)
+
+    def _filas(self, b: np.ndarray) -> np.ndarray:
+        return np.unpackbits(b, count=self.n).astype(bool)
+
+    def mascara(self, expr: str) -> np.ndarray:
+        """Máscara booleana (una entrada por fila de ctx.df) del filtro 'expr'."""
+        nodo, columnas = _parse_filtro(expr)
+        return self._filas(self._evaluar(nodo, columnas))
+
+    def particion(self, dims: list) -> dict:
+        """{filtro: máscara} con un segmento por valor (o combinación no vacía) de 'dims'."""
+        partes = {"": None}
+        for dim in dims:
+            bm = self.bitmaps(dim)
+            nuevas = {}
+            for filtro, base in partes.items():
+                for valor, b in bm.items():
+                    b = b if base is None else base & b
+                    if b.any():
+                        cond = f"{dim} == {str(valor)!r}"
+                        nuevas[f"{filtro} & {cond}" if filtro else cond] = b
+            partes = nuevas
+        return {filtro: self._filas(b) for filtro, b in partes.items()}
+
+_SIMBOLOS_SEGMENTO = {">=": " ge ", "<=": " le ", "!=": " ne ", ">": " gt ", "<": " lt ",
+                      "==": " ", "&": " y ", "|": " o ", "~": " no "}
+
+def _codigo_md(texto: str) -> str:
+    """Texto como código en línea de Markdown (doble comilla invertida si ya trae alguna)."""
+    return f"`` {texto} ``" if "`" in texto else f"`{texto}`"
+
+def _nombre_segmento(filtro: str) -> str:
+    """Nombre de carpeta legible a partir del filtro ("EDAD2 >= 35" -> "edad2-ge-35")."""
+    for simbolo, texto in _SIMBOLOS_SEGMENTO.items():
+        filtro = filtro.replace(simbolo, texto)
+    return _slug(filtro) or "segmento"
+
+@contextlib.contextmanager
+def _en_carpeta(report_dir: Path):
+    """Reportes, figuras y manifiesto en 'report_dir' mientras dure el bloque."""
+    global REPORT_DIR, FIG_DIR, MANIFEST_PATH
+    antes = REPORT_DIR, FIG_DIR, MANIFEST_PATH
+    REPORT_DIR, FIG_DIR, MANIFEST_PATH = report_dir, report_dir / "figs", report_dir / ".manifest.json"
+    try:
+        yield
+    finally:
+        REPORT_DIR, FIG_DIR, MANIFEST_PATH = antes
+
+@_perfilado("segmentos")
+def run_segmentos(filtros=(), por: list = None, ctx: Contexto = None, save_md: bool = True) -> dict:
+    """Demografía y análisis familiar por segmento, todos desde un solo Contexto.
+
+    'filtros' son expresiones (o {nombre: expresión}); 'por' agrega un segmento
+    por cada valor (o combinación) de esas dimensiones, p. ej. ["grado"] o
+    ["rango_edad"]. Cada segmento deja sus reportes en reportes/segmentos/<nombre>/
+    y el índice queda en reportes/segmentos.md. Dos filtros con el mismo nombre
+    son un error (uno pisaría los reportes del otro); un filtro que no se puede
+    evaluar lanza FiltroInvalido antes de generar ningún reporte.
+    """
+    _ensure_dirs()
+    ctx = ctx or _contexto_limpio()
+    indice = IndiceSegmentos(ctx)
+    if not isinstance(filtros, dict):
+        nombres = [_nombre_segmento(f) for f in filtros]
+        repetidos = sorted({n for n in nombres if nombres.count(n) > 1})
+        if repetidos:
+            raise ValueError(f"Segmentos con el mismo nombre: {', '.join(repetidos)} (use {{nombre: filtro}})")
+        filtros = dict(zip(nombres, filtros))
+    with _etapa("mascaras", filas=indice.n):
+        mascaras = {nombre: (expr, indice.mascara(expr)) for nombre, expr in filtros.items()}
+        if por:
+            for expr, mask in indice.particion(por).items():
+                nombre = _nombre_segmento(expr)
+                mascaras[nombre if nombre not in mascaras else f"{nombre}-{len(mascaras)}"] = (expr, mask)
+
+    base = REPORT_DIR / "segmentos"
+    segmentos = {}
+    for nombre, (expr, mask) in mascaras.items():
+        n = int(mask.sum())
+        seg = {"filtro": expr, "registros": n, "carpeta": base / nombre}
+        if n:
+            sub = ctx.subconjunto(mask, expr)
+            with _en_carpeta(base / nombre), _etapa(f"segmento:{nombre}", filas=n):
+                seg["demografia"] = run_demografia(save_md=save_md, ctx=sub)
+                seg["familiar"] = run_familiar(save_md=save_md, ctx=sub)
+        segmentos[nombre] = seg
+
+    if save_md:
+        _write_segmentos_md(segmentos, ctx)
+        _manifest().save()
+    return segmentos
+
+def _write_segmentos_md(segmentos: dict, ctx: Contexto) -> None:
+    total = len(ctx.df)
+    filas = []
+    for nombre, seg in segmentos.items():
+        n = seg["registros"]
+        enlaces = (f"[demografía](segmentos/{nombre}/demografia_basica.md) · "
+                   f"[familiar](segmentos/{nombre}/analisis_familiar.md)") if n else "_sin registros_"
+        filas.append({
+            "Segmento": nombre,
+            "Filtro": _codigo_md(seg["filtro"]),
+            "Registros": n,
+            "% del total": round(100 * n / total, 2) if total else 0.0,
+            "% casados": seg["familiar"]["pct_casados"] if n else "-",
+            "Reportes": enlaces,
+        })
+    md = [
+        "# Reportes por segmento",
+        f"_Actualizado: {dt.datetime.now():%Y-%m-%d %H:%M}_",
+        f"_Fuente de datos: `{_rel(ctx.data_path)}` ({total} registros)_",
+        "",
+        _df_to_md(pd.DataFrame(filas)) if filas else "_No se pidió ningún segmento._",
+    ]
+    _write_md(REPORT_DIR / "segmentos.md", "\n".join(md))
+
+# ---------------------------------------------------------------------
+# Modo por lotes: un archivo por base/unidad/año en un pool de procesos
+# ---------------------------------------------------------------------
+# Configuración que el proceso principal pasa a cada trabajador (con 'spawn'
+# los trabajadores no heredan los valores fijados desde la línea de comandos)
+_BATCH_CONFIG = ("SCHEMA_PATH", "INCREMENTAL", "FIGURAS", "EXPORT_FORMAT", "READ_ENGINE",
+                 "DEDUPE_MODE", "DEDUPE_KEYS", "DEDUPE_BLOCK", "DEDUPE_UMBRAL")
+
+def _batch_ids(files: list) -> list:
+    """Nombre corto y único por archivo (carpeta_nombre si dos archivos se llaman igual)."""
+    stems = [f.stem for f in files]
+    return [f"{f.parent.name}_{f.stem}" if stems.count(f.stem) > 1 else f.stem for f in files]
+
+def _batch_worker(path: Path, report_dir: Path, project_dir: Path, config: dict, export: bool) -> dict:
+    """Limpia y analiza un archivo (reportes propios en 'report_dir').
+
+    Devuelve solo agregados parciales que se suman de forma exacta: el cubo
+    del archivo (conteos y sumas), los faltantes por columna y los totales
+    de la limpieza; el DataFrame no vuelve al proceso principal.
+    """
+    globals().update(config, JOBS=1, EXPORT_BACKGROUND=False, PERFIL=None)
+    configurar_rutas(project_dir, path, report_dir=report_dir)
+    cal = run_calidad(save_md=True, export=export)
+    ctx = cal["ctx"]
+    run_demografia(save_md=True, ctx=ctx)
+    run_familiar(save_md=True, ctx=ctx)
+    cubo = build_cubo(ctx, save=False)
+    return {
+        "filas": len(ctx.df),
+        "duplicados": cal["duplicados_eliminados"],
+        "edad_imputada_media": cal["edad_imputada_media"],
+        "faltantes": ctx.df.isna().sum(),
+        "cubo": cubo.data,
     }
 
+def _merge_cubos(partes: dict) -> Cubo:
+    """Suma exacta de los cubos por archivo; 'archivo' queda como una dimensión más."""
+    frames = [data.assign(archivo=nombre) for nombre, data in partes.items()]
+    data = pd.concat(frames, ignore_index=True)
+    dims = ["archivo"] + [c for c in data.columns if c not in CUBE_MEASURES and c != "archivo"]
+    for d in dims:
+        if isinstance(data[d].dtype, pd.CategoricalDtype):
+            data[d] = data[d].astype(object)
+    data = (data.groupby(dims, observed=True, dropna=False)[list(CUBE_MEASURES)].sum()
+            .reset_index())
+    return Cubo(data, dims)
+
+@_perfilado("lote")
+def run_lote(pattern: str, jobs: int = None, export: bool = True) -> dict:
+    """Procesa todos los archivos de 'pattern' en paralelo y escribe el consolidado.
+
+    Cada archivo deja sus reportes en reportes/lotes/<archivo>/; el consolidado
+    (reportes/consolidado.md y el cubo con la dimensión 'archivo') sale de
+    sumar los agregados parciales de los trabajadores.
+    """
+    import glob
+    from concurrent.futures import ProcessPoolExecutor
+    files = sorted(Path(f).resolve() for f in glob.glob(pattern, recursive=True) if Path(f).is_file())
+    if not files:
+        raise ValueError(f"Ningún archivo coincide con {pattern}")
+    _ensure_dirs()
+    ids = _batch_ids(files)
+    config = {k: globals()[k] for k in _BATCH_CONFIG}
+    report_dirs = [REPORT_DIR / "lotes" / i for i in ids]
+    workers = min(jobs or os.cpu_count() or 1, len(files))
+    with _etapa("archivos", filas=len(files)):
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(_batch_worker, f, d, PROJECT_DIR, config, export)
+                       for f, d in zip(files, report_dirs)]
+            partes = dict(zip(ids, (fut.result() for fut in futures)))
+
+    with _etapa("consolidar", filas=len(files)):
+        cubo = _merge_cubos({i: p["cubo"] for i, p in partes.items()})
+        cubo.guardar()
+        total = sum(p["filas"] for p in partes.values())
+        faltantes = pd.concat([p["faltantes"] for p in partes.values()], axis=1).fillna(0).sum(axis=1)
+    _write_consolidado_md(files, ids, report_dirs, partes, cubo, faltantes.astype("int64"), total)
+    _manifest().save()
+    return {"archivos": ids, "filas": total, "cubo": cubo, "partes": partes}
+
+def _write_consolidado_md(files, ids, report_dirs, partes, cubo: Cubo, faltantes, total):
+    por_archivo = pd.DataFrame({
+        "Archivo": [_rel(f) for f in files],
+        "Registros": [partes[i]["filas"] for i in ids],
+        "Duplicados eliminados": [partes[i]["duplicados"] for i in ids],
+        "Edad imputada": [partes[i]["edad_imputada_media"] for i in ids],
+        "Reportes": [f"[{i}]({d.relative_to(REPORT_DIR).as_posix()}/calidad_datos.md)"
+                     for i, d in zip(ids, report_dirs)],
+    })
+    general = cubo.consultar()
+    md = [
+        "# Reporte consolidado",
+        f"_Actualizado: {dt.datetime.now():%Y-%m-%d %H:%M}_",
+        "",
+        f"- Archivos: **{len(files)}**",
+        f"- Total de registros (después de limpieza): **{total}**",
+        f"- Edad promedio: **{general['edad_media'].iloc[0]}** (desv. **{general['edad_std'].iloc[0]}**)",
+        f"- Cubo con la dimensión `archivo`: `{_rel(_cube_path())}` (ver `--consulta`)",
+        "",
+        "## Archivos",
+        _df_to_md(por_archivo),
+    ]
+    if "genero" in cubo.dims:
+        md += ["", "## Distribución por género", _df_to_md(cubo.consultar(["genero"]).reset_index())]
+    if "ec" in cubo.dims:
+        n = cubo.data.groupby("ec", dropna=False)["n"].sum()
+        casados = int(n[n.index.isin(CASADO_VALUES)].sum())
+        md += ["", "## Estado civil",
+               f"- Casados: **{round(100 * casados / max(total, 1), 2)}%**",
+               "", _df_to_md(cubo.consultar(["ec"]).reset_index())]
+        if "genero" in cubo.dims:
+            md += ["", "### Estado civil × Género (porcentaje por estado civil)",
+                   _df_to_md(cubo.crosstab("ec", "genero").reset_index())]
+    hijos_md = []
+    for rol, texto in (("hijos", "Con hijos"), ("conv", "Viven con familia/hijos")):
+        if rol in cubo.dims:
+            si = int(cubo.data.loc[cubo.data[rol].eq(True).fillna(False).astype(bool), "n"].sum())
+            hijos_md.append(f"- {texto}: **{si}**")
+    if hijos_md:
+        md += ["", "## Hijos y convivencia", *hijos_md]
+    md += ["", "## Datos faltantes (todos los archivos)", _df_to_md(_top_missing(faltantes, total))]
+    _write_md(REPORT_DIR / "consolidado.md", "\n".join(md))
+
 # ---------------------------------------------------------------------
 # Resumen ejecutivo
 # ---------------------------------------------------------------------
-def build_resumen():
+@_perfilado("resumen")
+def build_resumen(export: bool = True, chunksize: int = None):
     REPORT_DIR.mkdir(parents=True, exist_ok=True)
-    cal  = run_calidad(save_md=True)
-    demo = run_demografia(save_md=True)
-    fam  = run_familiar(save_md=True)
+    # Una sola lectura + limpieza; el mismo DataFrame pasa a los pasos 2 y 3
+    if chunksize:
+        cal = run_calidad_stream(chunksize, save_md=True)
+        ctx = _contexto_limpio()
+    else:
+        cal = run_calidad(save_md=True, export=export)
+        ctx = cal["ctx"]
+    demo = run_demografia(save_md=True, ctx=ctx)
+    fam  = run_familiar(save_md=True, ctx=ctx)
 
     results_md = PROJECT_DIR / "resultados_analisis.md"
 
@@ -531,33 +2695,395 @@ _Última ejecución: {dt.datetime.now():%Y-%m-%d %H:%M}_
    * Los **viudos** y **divorciados** concentran edades mayores.  
    👉 Esto confirma un patrón esperado: a mayor edad, más probabilidad de cambios en estado civil.
 
-**Dataset utilizado para Paso 2 y 3:** `{_prefer_clean_path().relative_to(PROJECT_DIR).as_posix()}`
+**Dataset utilizado para Paso 2 y 3:** `{_rel(cal['cache_file'])}`
 """
-    results_md.write_text(resumen, encoding="utf-8")
+    _write_md(results_md, resumen)
+    _manifest().save()
+    _wait_export(cal.get("export"))
     print(f"Resúmenes y reportes listos en: {results_md}")
 
+# ---------------------------------------------------------------------
+# Modo servidor (--serve): dataset limpio y cubo en memoria, reportes y
+# figuras bajo demanda en http://localhost, recarga al cambiar la fuente
+# ---------------------------------------------------------------------
+_REPORTES = {
+    "calidad": "calidad_datos.md",
+    "demografia": "demografia_basica.md",
+    "familiar": "analisis_familiar.md",
+}
+
+class CacheLRU:
+    """Salidas ya generadas (texto o PNG) por URL; al llenarse descarta la menos usada."""
+
+    def __init__(self, maximo: int = 64):
+        self.maximo = maximo
+        self.aciertos = self.fallos = 0
+        self._datos = OrderedDict()
+
+    def __contains__(self, clave) -> bool:
+        return clave in self._datos
+
+    def __len__(self) -> int:
+        return len(self._datos)
+
+    def get(self, clave):
+        if clave not in self._datos:
+            self.fallos += 1
+            return None
+        self.aciertos += 1
+        self._datos.move_to_end(clave)
+        return self._datos[clave]
+
+    def put(self, clave, valor) -> None:
+        self._datos[clave] = valor
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.maximo:
+            self._datos.popitem(last=False)
+
+    def clear(self) -> None:
+        self._datos.clear()
+
+def _slug(titulo: str) -> str:
+    return re.sub(r"[^\w]+", "-", titulo.strip().lower()).strip("-")
+
+def _seccion_md(texto: str, nombre: str) -> str:
+    """Sección '## ...' del reporte cuyo título, en minúsculas y con guiones, es 'nombre'."""
+    secciones, actual = {}, None
+    for linea in texto.splitlines():
+        if linea.startswith("## "):
+            actual = _slug(linea[3:])
+            secciones[actual] = []
+        if actual is not None:
+            secciones[actual].append(linea)
+    if nombre not in secciones:
+        raise LookupError(f"Sección desconocida: {nombre} (disponibles: {', '.join(secciones)})")
+    return "\n".join(secciones[nombre]).strip() + "\n"
+
+class Servidor:
+    """Mantiene el Contexto limpio y el cubo en memoria y responde pedidos GET.
+
+    Todo lo que toca el pipeline (recarga, reportes, figuras) corre en un hilo
+    y de a uno por vez (los pasos usan estado global); lo que ya está en la
+    CacheLRU se responde sin pasar por el pipeline.
+    """
+
+    def __init__(self, cache_max: int = 64, intervalo: float = 2.0):
+        self.cache = CacheLRU(cache_max)
+        self.intervalo = intervalo
+        self.ctx = None
+        self.cubo = None
+        self.firma = None
+        self.cargado = None
+        self.recargas = 0
+        self._lock = None
+
+    def _firma(self) -> tuple:
+        """Tamaño y mtime de la fuente y del esquema (basta un stat para notar cambios)."""
+        firma = []
+        for path in (DATA_PATH, SCHEMA_PATH):
+            with contextlib.suppress(OSError):
+                st = path.stat()
+                firma.append((str(path), st.st_mtime_ns, st.st_size))
+        return tuple(firma)
+
+    def cargar(self) -> None:
+        """(Re)carga el dataset limpio; si la fuente no cambió sale de la caché columnar."""
+        t0 = time.perf_counter()
+        self.firma = self._firma()
+        cal = run_calidad(save_md=True, export=False)
+        self.ctx = cal["ctx"]
+        self.cubo = build_cubo(self.ctx, save=False)
+        self.cache.clear()
+        self.recargas += 1
+        self.cargado = dt.datetime.now()
+        print(f"Datos cargados: {len(self.ctx.df)} registros de {_rel(DATA_PATH)} "
+              f"en {time.perf_counter() - t0:.2f} s" + (" (caché)" if cal.get("omitido") else ""))
+
+    def estado(self) -> dict:
+        return {
+            "fuente": _rel(DATA_PATH),
+            "registros": len(self.ctx.df) if self.ctx is not None else 0,
+            "cargado": f"{self.cargado:%Y-%m-%d %H:%M:%S}" if self.cargado else None,
+            "recargas": self.recargas,
+            "cache": {"entradas": len(self.cache), "maximo": self.cache.maximo,
+                      "aciertos": self.cache.aciertos, "fallos": self.cache.fallos},
+        }
+
+    # ---- Generadores (corren en un hilo, con el lock tomado)
+    def _reporte(self, nombre: str) -> str:
+        if nombre == "demografia":
+            run_demografia(save_md=True, ctx=self.ctx)
+        elif nombre == "familiar":
+            run_familiar(save_md=True, ctx=self.ctx)
+        return (REPORT_DIR / _REPORTES[nombre]).read_text(encoding="utf-8")
+
+    def _figura(self, nombre: str) -> bytes:
+        path = FIG_DIR / nombre
+        if not path.is_file():
+            raise LookupError(f"No existe la figura {nombre}")
+        return path.read_bytes()
+
+    def _consulta(self, params: dict) -> str:
+        """Roll-up del cubo: ?por=dim1,dim2&dim=valor (varios valores separados por coma)."""
+        por = [d for d in params.pop("por", "").split(",") if d]
+        filtros = {}
+        for dim, txt in params.items():
+            self.cubo._check_dims([dim])
+            valores = {str(v): v for v in self.cubo.data[dim].unique()}
+            filtros[dim] = [valores.get(v, v) for v in txt.split(",")]
+        return _df_to_md(self.cubo.consultar(por, filtros).reset_index(), index=False)
+
+    async def _en_hilo(self, clave, fn, *args):
+        """Salida de la caché o, si no está, generada en un hilo (un pedido a la vez)."""
+        valor = self.cache.get(clave)
+        if valor is None:
+            async with self._lock:
+                valor = self.cache.get(clave) if clave in self.cache else None
+                if valor is None:
+                    valor = await asyncio.to_thread(fn, *args)
+                    self.cache.put(clave, valor)
+        return valor
+
+    async def responder(self, destino: str) -> tuple:
+        """(estado HTTP, Content-Type, cuerpo) para la URL pedida."""
+        url = urllib.parse.urlsplit(destino)
+        partes = [urllib.parse.unquote(p) for p in url.path.split("/") if p]
+        md = "text/markdown; charset=utf-8"
+        try:
+            if not partes:
+                return 200, md, self._indice().encode()
+            if partes == ["estado"]:
+                return 200, "application/json", json.dumps(self.estado(), ensure_ascii=False).encode()
+            if partes == ["consulta"]:
+                params = dict(urllib.parse.parse_qsl(url.query))
+                clave = "/consulta?" + urllib.parse.urlencode(sorted(params.items()))
+                return 200, md, (await self._en_hilo(clave, self._consulta, params)).encode()
+            if len(partes) == 3 and partes[:2] == ["reportes", "figs"]:
+                informe = partes[2].split("_")[0]
+                if informe not in _REPORTES or Path(partes[2]).name != partes[2]:
+                    raise LookupError(f"No existe la figura {partes[2]}")
+                await self._en_hilo(f"/reportes/{informe}", self._reporte, informe)  # dibuja sus figuras
+                return 200, "image/png", await self._en_hilo(url.path, self._figura, partes[2])
+            if len(partes) in (2, 3) and partes[0] == "reportes" and partes[1] in _REPORTES:
+                texto = await self._en_hilo(f"/reportes/{partes[1]}", self._reporte, partes[1])
+                if len(partes) == 3:
+                    texto = _seccion_md(texto, partes[2])
+                return 200, md, texto.encode()
+            raise LookupError(f"No existe {url.path}")
+        except LookupError as e:
+            return 404, "text/plain; charset=utf-8", str(e).strip("'\"").encode()
+        except ValueError as e:
+            return 400, "text/plain; charset=utf-8", str(e).encode()
+
+    def _indice(self) -> str:
+        return "\n".join([
+            "# Reportes FAC (servidor)",
+            f"_Fuente: `{_rel(DATA_PATH)}` ({self.estado()['registros']} registros, "
+            f"cargado {self.estado()['cargado']})_",
+            "",
+            *[f"- [{nombre}](/reportes/{nombre}) — secciones en `/reportes/{nombre}/<sección>`"
+              for nombre in _REPORTES],
+            "- Figuras: `/reportes/figs/<archivo>.png`",
+            f"- Cubo: `/consulta?por=genero,rango_edad&ec=CASADO` (dimensiones: {', '.join(self.cubo.dims)})",
+            "- Estado y caché: [/estado](/estado)",
+        ]) + "\n"
+
+    # ---- HTTP y vigilancia de la fuente
+    async def atender(self, reader, writer) -> None:
+        try:
+            pedido = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass   # cabeceras: no se usan
+            if len(pedido) != 3:
+                estado, tipo, cuerpo = 400, "text/plain", b"Pedido mal formado"
+            elif pedido[0] not in ("GET", "HEAD"):
+                estado, tipo, cuerpo = 405, "text/plain", b"Solo GET"
+            else:
+                estado, tipo, cuerpo = await self.responder(pedido[1])
+            writer.write((f"HTTP/1.1 {estado} {HTTPStatus(estado).phrase}\r\n"
+                          f"Content-Type: {tipo}\r\nContent-Length: {len(cuerpo)}\r\n"
+                          "Connection: close\r\n\r\n").encode("latin-1"))
+            if pedido[:1] != ["HEAD"]:
+                writer.write(cuerpo)
+            await writer.drain()
+        except Exception as e:   # un pedido que falla no debe tumbar el servidor
+            print(f"Error atendiendo pedido: {e!r}")
+        finally:
+            writer.close()
+
+    async def vigilar(self) -> None:
+        """Cada 'intervalo' segundos revisa la fuente y el esquema; si cambiaron, recarga."""
+        while True:
+            await asyncio.sleep(self.intervalo)
+            if self._firma() == self.firma:
+                continue
+            async with self._lock:
+                try:
+                    await asyncio.to_thread(self.cargar)
+                except Exception as e:   # p. ej. el archivo aún se está copiando
+                    print(f"No se pudo recargar {_rel(DATA_PATH)}: {e!r} (se siguen sirviendo los datos anteriores)")
+
+    async def servir(self, host: str, port: int) -> None:
+        self._lock = asyncio.Lock()
+        server = await asyncio.start_server(self.atender, host, port)
+        print(f"Sirviendo reportes en http://{host}:{port}/ (Ctrl+C para salir)")
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.vigilar())
+
+def run_servidor(host: str = "127.0.0.1", port: int = 8000, cache_max: int = 64,
+                 intervalo: float = 2.0) -> None:
+    """Modo servidor: carga una vez y atiende pedidos hasta Ctrl+C."""
+    servidor = Servidor(cache_max, intervalo)
+    servidor.cargar()
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(servidor.servir(host, port))
+    print("Servidor detenido.")
+
 # ---------------------------------------------------------------------
 # CLI
 # ---------------------------------------------------------------------
-def parse_args():
+def parse_args() -> tuple:
+    """(parser, args); el parser queda para reportar errores que se ven recién con los datos."""
     ap = argparse.ArgumentParser(description="Generador de reportes FAC (Markdown) con limpieza.")
-    g = ap.add_mutually_exclusive_group(required=True)
+    # un modo por ejecución; --segmento y --segmentar-por se pueden combinar entre sí
+    g = ap.add_mutually_exclusive_group()
     g.add_argument("--all", action="store_true", help="Ejecuta limpieza + 3 pasos y genera el resumen.")
     g.add_argument("--calidad", action="store_true", help="Solo Paso 1: Calidad de datos (con limpieza).")
     g.add_argument("--demo", action="store_true", help="Solo Paso 2: Demografía básica.")
     g.add_argument("--familiar", action="store_true", help="Solo Paso 3: Análisis familiar.")
-    return ap.parse_args()
+    g.add_argument("--cubo", action="store_true",
+                   help="Construye el cubo pre-agregado (edad, género, grado, estado civil, hijos, convivencia).")
+    g.add_argument("--input-glob", metavar="PATRÓN",
+                   help="Modo por lotes: procesa cada archivo que coincida (p. ej. 'datos/**/*.xlsx') "
+                        "en un pool de --jobs procesos y escribe reportes/consolidado.md.")
+    g.add_argument("--consulta", metavar="DIMS",
+                   help="Consulta el cubo guardado, p. ej. --consulta genero,rango_edad (sin leer los datos).")
+    g.add_argument("--serve", action="store_true",
+                   help="Servidor local: mantiene los datos limpios en memoria y sirve reportes, "
+                        "secciones, figuras y consultas al cubo bajo demanda.")
+    seg = ap.add_argument_group("segmentos (modo propio; las dos opciones se pueden combinar)")
+    seg.add_argument("--segmento", action="append", metavar="[NOMBRE=]FILTRO",
+                     help="Reportes de demografía y análisis familiar solo para las filas del filtro, "
+                          "p. ej. \"GENERO == 'FEMENINO' & EDAD2 >= 35\" (se puede repetir).")
+    seg.add_argument("--segmentar-por", metavar="DIMS",
+                     help="Un segmento por cada valor de estas columnas o roles, p. ej. grado o "
+                          "rango_edad,genero (reportes en reportes/segmentos/).")
+    ap.add_argument("--no-export", "--no-xlsx", dest="no_export", action="store_true",
+                    help="No exportar el dataset limpio (solo se guarda la caché).")
+    ap.add_argument("--format", choices=EXPORT_FORMATS, default="xlsx",
+                    help="Formato de la exportación del dataset limpio (por defecto xlsx).")
+    ap.add_argument("--export-bg", action="store_true",
+                    help="Exporta el dataset limpio en segundo plano mientras siguen los pasos 2 y 3.")
+    ap.add_argument("--esquema", type=Path, default=None,
+                    help="Archivo de roles/alias de columnas (.toml o .yaml).")
+    ap.add_argument("--input", type=Path, default=None,
+                    help="Archivo fuente (.xlsx o .csv) en lugar de datos/JEFAB_2024.xlsx.")
+    ap.add_argument("--dedupe", choices=DEDUPE_MODES, default="exacto",
+                    help="Detección de duplicados: exacto, normalizado (sin espacios/mayúsculas) "
+                         "o difuso (casi iguales dentro de cada bloque).")
+    ap.add_argument("--dedupe-keys", metavar="COLS", default=None,
+                    help="Columnas o roles que identifican un registro, separados por coma (por defecto todas).")
+    ap.add_argument("--dedupe-block", metavar="COLS", default=None,
+                    help="Columnas o roles que definen los bloques del modo difuso (por defecto edad,genero).")
+    ap.add_argument("--dedupe-umbral", type=float, default=0.9,
+                    help="Fracción de columnas clave que deben coincidir en modo difuso (por defecto 0.9).")
+    ap.add_argument("--excel-engine", choices=("calamine", "openpyxl"), default=None,
+                    help="Motor para leer .xlsx (por defecto calamine si está instalado).")
+    ap.add_argument("--force", action="store_true",
+                    help="Regenera todo aunque las entradas no hayan cambiado.")
+    ap.add_argument("--jobs", type=int, default=None,
+                    help="Procesos para dibujar las figuras en paralelo (por defecto 1) o, con "
+                         "--input-glob, para procesar archivos (por defecto uno por núcleo).")
+    ap.add_argument("--host", default="127.0.0.1", help="Dirección de --serve (por defecto solo local).")
+    ap.add_argument("--port", type=int, default=8000, help="Puerto de --serve.")
+    ap.add_argument("--intervalo", type=float, default=2.0,
+                    help="Segundos entre revisiones de la fuente y el esquema en --serve.")
+    ap.add_argument("--cache-max", type=int, default=64,
+                    help="Salidas (reportes, figuras, consultas) que --serve guarda en memoria.")
+    ap.add_argument("--no-figs", action="store_true",
+                    help="No dibuja figuras (ni importa matplotlib); los reportes se escriben igual.")
+    ap.add_argument("--chunksize", type=int, default=None,
+                    help="Limpieza por bloques de N filas (para archivos que no caben en memoria).")
+    ap.add_argument("--profile", nargs="?", const="tiempo", choices=("tiempo", "memoria"), default=None,
+                    help="Mide cada etapa y escribe reportes/perfil.{json,md} y perfil_chrome.json "
+                         "('memoria' añade picos de tracemalloc).")
+    args = ap.parse_args()
+
+    modo = any((args.all, args.calidad, args.demo, args.familiar, args.cubo, args.input_glob,
+                args.consulta is not None, args.serve))
+    segmentos = bool(args.segmento or args.segmentar_por)
+    if not modo and not segmentos:
+        ap.error("se requiere un modo: --all, --calidad, --demo, --familiar, --cubo, --input-glob, "
+                 "--consulta, --serve o --segmento/--segmentar-por")
+    if modo and segmentos:
+        ap.error("--segmento/--segmentar-por no se combinan con otro modo")
+    # {nombre: filtro}; el nombre explícito (NOMBRE=) o uno derivado del filtro
+    args.filtros = {}
+    for txt in args.segmento or []:
+        m = re.match(r"^(\w+)\s*=(?!=)\s*(.+)$", txt)
+        nombre, expr = m.groups() if m else (_nombre_segmento(txt), txt)
+        if nombre in args.filtros:
+            ap.error(f"--segmento: el nombre '{nombre}' se repite (use NOMBRE=FILTRO para distinguirlos)")
+        try:
+            _parse_filtro(expr)
+        except FiltroInvalido as e:
+            ap.error(f"--segmento: {e}")
+        args.filtros[nombre] = expr
+    return ap, args
 
 if __name__ == "__main__":
-    args = parse_args()
+    ap, args = parse_args()
+    if args.input:
+        DATA_PATH = args.input.resolve()
+    if args.esquema:
+        SCHEMA_PATH = args.esquema.resolve()
+    if args.force:
+        INCREMENTAL = False
+    JOBS = max(1, args.jobs or 1)
+    FIGURAS = not args.no_figs
+    EXPORT_FORMAT = args.format
+    EXPORT_BACKGROUND = args.export_bg
+    READ_ENGINE = args.excel_engine
+    DEDUPE_MODE = args.dedupe
+    DEDUPE_KEYS = [c.strip() for c in args.dedupe_keys.split(",")] if args.dedupe_keys else None
+    DEDUPE_BLOCK = [c.strip() for c in args.dedupe_block.split(",")] if args.dedupe_block else None
+    DEDUPE_UMBRAL = args.dedupe_umbral
+    if args.profile:
+        PERFIL = _Perfil(memoria=args.profile == "memoria")
     if args.all:
-        build_resumen()
+        build_resumen(export=not args.no_export, chunksize=args.chunksize)
     elif args.calidad:
-        run_calidad(save_md=True)
-        print(f"Reporte: {REPORT_DIR/'calidad_datos.md'}\nDataset limpio: {CLEAN_PATH}")
+        if args.chunksize:
+            cal = run_calidad_stream(args.chunksize, save_md=True)
+        else:
+            cal = run_calidad(save_md=True, export=not args.no_export)
+            _wait_export(cal["export"])
+        print(f"Reporte: {REPORT_DIR/'calidad_datos.md'}\nDataset limpio: {cal['clean_file'] or cal['cache_file']}")
     elif args.demo:
         run_demografia(save_md=True)
         print(f"Reporte: {REPORT_DIR/'demografia_basica.md'}")
     elif args.familiar:
         run_familiar(save_md=True)
         print(f"Reporte: {REPORT_DIR/'analisis_familiar.md'}")
+    elif args.cubo:
+        cubo = build_cubo()
+        print(f"Cubo: {_cube_path()} ({len(cubo.data)} celdas, dimensiones: {', '.join(cubo.dims)})")
+    elif args.input_glob:
+        lote = run_lote(args.input_glob, jobs=args.jobs, export=not args.no_export)
+        print(f"{len(lote['archivos'])} archivos, {lote['filas']} registros. "
+              f"Consolidado: {REPORT_DIR/'consolidado.md'}")
+    elif args.consulta is not None:
+        por = [d.strip() for d in args.consulta.split(",") if d.strip()]
+        print(_df_to_md(Cubo.cargar().consultar(por).reset_index(), index=False))
+    elif args.segmento or args.segmentar_por:
+        por = [d.strip() for d in args.segmentar_por.split(",")] if args.segmentar_por else None
+        try:
+            segs = run_segmentos(args.filtros, por=por)
+        except FiltroInvalido as e:
+            ap.error(str(e))   # el filtro no encaja con los datos (columna, tipo u operador)
+        print(f"{len(segs)} segmentos. Índice: {REPORT_DIR/'segmentos.md'}")
+    elif args.serve:
+        run_servidor(args.host, args.port, cache_max=args.cache_max, intervalo=args.intervalo)
+    if PERFIL is not None:
+        rutas = PERFIL.exportar(REPORT_DIR)
+        print("Perfil: " + ", ".join(str(r) for r in rutas))